@@ -0,0 +1,109 @@
+"""
+目录页解析基准测试
+
+对比原有的 BeautifulSoup 解析与 public.parse_catalog 的流式解析，
+先校验两者提取的标题、信息、简介、完结状态和章节列表一致，再比较耗时和内存峰值。
+
+默认使用生成的目录页（章节数由 --chapters 指定），
+也可以把保存下来的目录页 html 放进 benchmarks/corpus/catalog 目录一并测试：
+
+    python benchmarks/bench_catalog.py [--chapters 3000] [-n 重复次数]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import public as p  # noqa: E402
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "catalog")
+
+
+# 原有实现：构建完整的文档树，章节为 Tag 对象，使用时再查找链接和章节ID
+def legacy_parse(html):
+    soup = BeautifulSoup(html, "html.parser")
+    title = p.rename(soup.find("h1").get_text())
+    info = soup.find("div", class_="page-header-info").get_text()
+    intro = soup.find("div", class_="page-abstract-content").get_text()
+    chapters = soup.find_all("div", class_="chapter-item")
+    finished = 1 if soup.find("span", class_="info-label-yellow").get_text() == "已完结" else 0
+    return title, info, intro, chapters, finished
+
+
+def legacy_chapter_records(chapters):
+    return [(re.search(r"/reader/(\d+)", chapter.find("a")["href"]).group(1), chapter.find("a").get_text())
+            for chapter in chapters]
+
+
+def generate_page(chapters):
+    """生成与番茄目录页结构相同的页面"""
+    items = "".join(
+        f'<div class="chapter-item"><a href="/reader/{7000000000000000000 + i}" class="chapter-item-title" '
+        f'target="_blank">第{i + 1}章 风起&amp;云涌 {i}</a><span class="chapter-item-time"></span></div>'
+        for i in range(chapters))
+    return f"""<!DOCTYPE html><html><head><meta charset="utf-8"><title>测试</title>
+<script>window.__INITIAL_STATE__={{"page":{{"bookId":"1"}}}}</script></head><body>
+<div class="muye-header"><div class="page-header-info"><div class="info"><h1>测试小说：长夜</h1>
+<div class="info-label"><span class="info-label-yellow">连载中</span><span class="info-label-grey">玄幻</span></div>
+<div class="info-count"><span class="info-count-word">123.4万字</span></div></div></div></div>
+<div class="page-abstract-content"><p>这是一段简介<br>第二行</p></div>
+<div class="page-directory-content"><div class="volume">第一卷</div><div class="chapter">{items}</div></div>
+</body></html>"""
+
+
+def measure(func, html, number):
+    elapsed = min(timed(func, html) for _ in range(number))
+    tracemalloc.start()
+    result = func(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return elapsed, peak
+
+
+def timed(func, html):
+    start = time.perf_counter()
+    func(html)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="目录页解析基准测试")
+    parser.add_argument("--chapters", type=int, default=3000, help="生成的目录页章节数")
+    parser.add_argument("-n", "--number", type=int, default=5, help="重复次数，取最快的一次")
+    args = parser.parse_args()
+
+    pages = {f"generated-{args.chapters}": generate_page(args.chapters)}
+    if os.path.isdir(CORPUS_DIR):
+        for filename in sorted(os.listdir(CORPUS_DIR)):
+            if filename.endswith(".html"):
+                with open(os.path.join(CORPUS_DIR, filename), "r", encoding="utf-8") as f:
+                    pages[filename] = f.read()
+
+    for name, html in pages.items():
+        legacy = legacy_parse(html)
+        new = p.parse_catalog(html)
+        if legacy[:3] + legacy[4:] != new[:3] + new[4:] or legacy_chapter_records(legacy[3]) != \
+                [(chapter.id, chapter.title) for chapter in new[3]]:
+            print(f"解析结果不一致: {name}")
+            return 1
+
+        # 原实现的章节还需要在下载时逐个查找链接和章节ID，一并计入
+        legacy_time, legacy_peak = measure(lambda h: legacy_chapter_records(legacy_parse(h)[3]), html, args.number)
+        new_time, new_peak = measure(p.parse_catalog, html, args.number)
+        print(f"{name}: {len(new[3])} 个章节，{len(html) / 1024:.0f} KB")
+        print(f"  BeautifulSoup  {legacy_time * 1000:>8.1f} ms  内存峰值 {legacy_peak / 1024 / 1024:>7.2f} MB")
+        print(f"  parse_catalog  {new_time * 1000:>8.1f} ms  内存峰值 {new_peak / 1024 / 1024:>7.2f} MB")
+        print(f"  加速 {legacy_time / new_time:.2f}x  内存减少 {legacy_peak / new_peak:.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
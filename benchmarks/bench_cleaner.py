@@ -0,0 +1,75 @@
+"""
+章节清洗微基准测试
+
+对比原有的逐个正则替换与 public.clean_chapter 的单次替换，
+先校验两者输出完全一致，再分别计时。
+
+语料为保存下来的章节接口响应（json 文件），默认读取 benchmarks/corpus/chapters，
+可以把线上抓到的接口响应直接放进该目录，或用参数指定其他目录：
+
+    python benchmarks/bench_cleaner.py [语料目录] [-n 重复次数]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import public as p  # noqa: E402
+
+
+# 原有实现：get_api 中的三次替换加上 fix_publisher 中的九次替换
+def legacy_clean(chapter_content):
+    chapter_text = re.search(r"<article>([\s\S]*?)</article>", chapter_content).group(1)
+    chapter_text = re.sub(r"<p>", "\n", chapter_text)
+    chapter_text = re.sub(r"</?\w+>", "", chapter_text)
+    return p.fix_publisher(chapter_text)
+
+
+def load_corpus(corpus_dir):
+    corpus = {}
+    for filename in sorted(os.listdir(corpus_dir)):
+        if filename.endswith(".json"):
+            with open(os.path.join(corpus_dir, filename), "r", encoding="utf-8") as f:
+                corpus[filename] = json.load(f)["data"]["content"]
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description="章节清洗微基准测试")
+    parser.add_argument("corpus", nargs="?",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "chapters"))
+    parser.add_argument("-n", "--number", type=int, default=200, help="每个章节重复清洗的次数")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        print(f"语料目录中没有章节: {args.corpus}")
+        return 1
+
+    # 校验输出完全一致
+    for name, content in corpus.items():
+        if legacy_clean(content).encode("utf-8") != p.clean_chapter(content).encode("utf-8"):
+            print(f"输出不一致: {name}")
+            return 1
+    print(f"{len(corpus)} 个章节输出一致")
+
+    total_legacy = total_new = 0
+    for name, content in corpus.items():
+        legacy = timeit.timeit(lambda: legacy_clean(content), number=args.number) / args.number
+        new = timeit.timeit(lambda: p.clean_chapter(content), number=args.number) / args.number
+        total_legacy += legacy
+        total_new += new
+        print(f"{name:<24} {len(content):>8} 字符  原实现 {legacy * 1e6:>9.1f} µs  "
+              f"单次替换 {new * 1e6:>9.1f} µs  加速 {legacy / new:.2f}x")
+    print(f"{'合计':<22} {'':>13}  原实现 {total_legacy * 1e6:>9.1f} µs  "
+          f"单次替换 {total_new * 1e6:>9.1f} µs  加速 {total_legacy / total_new:.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+"""
+端到端吞吐量基准测试
+
+在本地启动一个模拟服务器，代替番茄目录页、章节接口和 Telegram Bot API，
+完整运行 Spider.worker → crawl → fanqie_api.download → get_api → 存储/导出 → send_document，
+报告整体章节吞吐量、每个任务的首字节时间（从请求目录页到第一个章节接口返回）、耗时和下载进程内存峰值。
+
+目录页默认按 --chapters 生成，也可以把保存下来的目录页 html 放进 benchmarks/corpus/catalog 目录
+（文件名为书籍ID），章节接口按章节ID轮流返回 benchmarks/corpus/chapters 中的接口响应：
+
+    python benchmarks/bench_pipeline.py [--books 4] [--chapters 200] [--workers 2] [--concurrency 4]
+                                        [--latency 50] [--jitter 20] [--error-rate 0.01] [--speed-limit 0.01]
+
+--speed-limit 低于0.25时会解除下载限速的下限，仅用于本地测试。
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, "..", "src")
+CATALOG_DIR = os.path.join(BENCH_DIR, "corpus", "catalog")
+CHAPTERS_DIR = os.path.join(BENCH_DIR, "corpus", "chapters")
+
+sys.path.insert(0, BENCH_DIR)
+
+from bench_catalog import generate_page  # noqa: E402
+
+
+# 模拟服务器的状态和统计，由处理请求的线程共同更新
+class Upstream:
+    def __init__(self, args):
+        self.latency = args.latency / 1000
+        self.jitter = args.jitter / 1000
+        self.error_rate = args.error_rate
+        self.chapters = args.chapters
+        self.lock = threading.Lock()
+        self.catalogs = {}  # 书籍ID -> 目录页
+        self.chapter_books = {}  # 章节ID -> 书籍ID
+        self.contents = []
+        for filename in sorted(os.listdir(CHAPTERS_DIR)):
+            if filename.endswith(".json"):
+                with open(os.path.join(CHAPTERS_DIR, filename), "r", encoding="utf-8") as f:
+                    self.contents.append(f.read().encode("utf-8"))
+        self.requests = {"catalog": 0, "chapter": 0, "telegram": 0}
+        self.errors = 0
+        self.catalog_time = {}  # 书籍ID -> 首次请求目录页的时间
+        self.first_chapter_time = {}  # 书籍ID -> 第一个章节接口返回的时间
+        self.document_time = {}  # ChatID -> 收到文件的时间
+        self.document_size = {}
+        self.file_ids = 0
+
+    def catalog(self, book_id: str) -> bytes:
+        with self.lock:
+            if book_id not in self.catalogs:
+                path = os.path.join(CATALOG_DIR, f"{book_id}.html")
+                if os.path.exists(path):
+                    with open(path, "r", encoding="utf-8") as f:
+                        html = f.read()
+                else:
+                    # 生成的章节ID以书籍ID开头，保证不同书的章节不重复
+                    html = generate_page(self.chapters).replace('href="/reader/7', f'href="/reader/{book_id}')
+                for chapter_id in re.findall(r"/reader/(\d+)", html):
+                    self.chapter_books[chapter_id] = book_id
+                self.catalogs[book_id] = html.encode("utf-8")
+            return self.catalogs[book_id]
+
+    def delay(self):
+        time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+
+    def failed(self) -> bool:
+        if random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            return True
+        return False
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    upstream: Upstream = None
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        up = self.upstream
+        url = urlparse(self.path)
+        up.delay()
+        if url.path.startswith("/page/"):
+            book_id = url.path.rsplit("/", 1)[1]
+            with up.lock:
+                up.requests["catalog"] += 1
+                up.catalog_time.setdefault(book_id, time.perf_counter())
+            self.reply(200, up.catalog(book_id), "text/html; charset=utf-8")
+        elif url.path.startswith("/api/"):
+            with up.lock:
+                up.requests["chapter"] += 1
+            if up.failed():
+                self.reply(500, b"error", "text/plain")
+                return
+            chapter_id = parse_qs(url.query)["item_id"][0]
+            body = up.contents[int(chapter_id) % len(up.contents)]
+            self.reply(200, body, "application/json")
+            with up.lock:
+                up.first_chapter_time.setdefault(up.chapter_books.get(chapter_id), time.perf_counter())
+        else:
+            self.reply(404, b"not found", "text/plain")
+
+    def do_POST(self):
+        # Telegram Bot API 桩：只记录发送的文件，返回最小的 Message 对象
+        up = self.upstream
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urlparse(self.path)
+        method = url.path.rsplit("/", 1)[1]
+        # telebot 把参数放在查询字符串中，文件放在请求体中
+        chat_id = int(parse_qs(url.query).get("chat_id", ["0"])[0])
+        message = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        with up.lock:
+            up.requests["telegram"] += 1
+            if method == "sendDocument":
+                up.file_ids += 1
+                message["document"] = {"file_id": f"file{up.file_ids}", "file_unique_id": f"u{up.file_ids}"}
+                up.document_time[chat_id] = time.perf_counter()
+                up.document_size[chat_id] = len(body)
+            else:
+                message["text"] = ""
+        self.reply(200, json.dumps({"ok": True, "result": message}).encode("utf-8"), "application/json")
+
+
+def peak_rss(pid: int) -> int:
+    """返回进程的内存峰值（VmHWM），单位为字节，无法读取时返回 0"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端吞吐量基准测试")
+    parser.add_argument("--books", type=int, default=4, help="任务数量")
+    parser.add_argument("--chapters", type=int, default=200, help="生成的目录页章节数")
+    parser.add_argument("--workers", type=int, default=2, help="同时处理的书籍数量")
+    parser.add_argument("--concurrency", type=int, default=4, help="每本书同时进行的章节请求数")
+    parser.add_argument("--latency", type=float, default=50, help="模拟服务器响应延迟，单位为ms")
+    parser.add_argument("--jitter", type=float, default=20, help="响应延迟的随机波动，单位为ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="章节接口返回错误的概率")
+    parser.add_argument("--speed-limit", type=float, default=0.25, help="下载速度限制，单位为s/it")
+    parser.add_argument("--cache", action="store_true", help="启用章节和目录缓存")
+    parser.add_argument("--timeout", type=float, default=600, help="等待全部任务完成的最长时间，单位为s")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录")
+    parser.add_argument("--stats", action="store_true", help="同时输出 /stats 命令的各阶段统计")
+    args = parser.parse_args()
+
+    Handler.upstream = upstream = Upstream(args)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    # 在临时目录中按示例配置生成 config.json，切换到该目录后由 load_config() 读取、setup() 初始化数据库
+    workdir = tempfile.mkdtemp(prefix="bench-pipeline-")
+    with open(os.path.join(SRC_DIR, "config-example.json"), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    config.update({
+        "bot_token": "123456:bench",
+        "bot_api_url": base_url + "/bot{0}/{1}",
+        "database": os.path.join(workdir, "api.db"),
+        "save_dir": os.path.join(workdir, "output"),
+        "time_range": "false",
+        "speed_limit": args.speed_limit,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "max_tasks_per_child": 1,  # 每个任务使用新进程，进程的内存峰值即为任务的内存峰值
+    })
+    config["auto_update"]["enabled"] = False
+    config["cache"].update({"enabled": args.cache, "dir": os.path.join(workdir, "cache")})
+    config["http"].update({"page_url": base_url + "/page/{book_id}", "api_url": base_url + "/api/reader/full/v1/"})
+    config["log"].update({"filepath": os.path.join(workdir, "logs", "api.log"), "console_level": "WARNING"})
+    with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False)
+    os.chdir(workdir)
+    sys.path.insert(0, SRC_DIR)
+
+    import bot  # noqa: E402
+    import fetcher  # noqa: E402
+    # 解除限速下限，最高请求速度由主进程计算后通过共享的限速器状态传给下载进程
+    fetcher.MIN_SPEED_LIMIT = min(fetcher.MIN_SPEED_LIMIT, args.speed_limit)
+    bot.load_config()
+    bot.setup()
+
+    catalog_books = [filename[:-5] for filename in sorted(os.listdir(CATALOG_DIR))
+                     if filename.endswith(".html") and filename[:-5].isdigit()] if os.path.isdir(CATALOG_DIR) else []
+    book_ids = [catalog_books[i] if i < len(catalog_books) else str(100 + i) for i in range(args.books)]
+    chat_ids = {book_id: 1000 + i for i, book_id in enumerate(book_ids)}
+
+    spider = bot.Spider()
+    bot.spider = spider
+    start = time.perf_counter()
+    # 先添加任务再启动工作线程，避免工作线程空等
+    for book_id in book_ids:
+        bot.api({"action": "add", "id": book_id}, chat_ids[book_id])
+    spider.start()
+
+    # 等待全部任务结束，同时记录下载进程的内存峰值
+    peaks = {}
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        for process in list(spider.pool._pool):
+            if process.pid is not None:
+                peaks[process.pid] = max(peaks.get(process.pid, 0), peak_rss(process.pid))
+        cur = bot.db.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM novels WHERE id IN ({','.join('?' * len(book_ids))}) "
+                    f"AND status NOT IN ('等待中', '进行中')", book_ids)
+        done = cur.fetchone()[0]
+        cur.close()
+        if done == len(book_ids):
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    spider.stop()
+    server.shutdown()
+
+    cur = bot.db.cursor()
+    cur.execute("SELECT id, status, chapters FROM novels")
+    rows = {row[0]: row[1:] for row in cur.fetchall()}
+    cur.close()
+    total = sum(rows[book_id][1] or 0 for book_id in book_ids if rows[book_id][0] == "已完成")
+
+    print(f"{len(book_ids)} 本书，{args.workers} 个工作线程，每本书并发 {args.concurrency}，"
+          f"延迟 {args.latency:.0f}±{args.jitter:.0f} ms，错误率 {args.error_rate:.1%}")
+    print(f"{'书籍ID':<10} {'状态':<6} {'章节':>6} {'首字节':>9} {'耗时':>9} {'章节/s':>8} {'文件':>9}")
+    for book_id in book_ids:
+        status, chapters = rows[book_id]
+        begin = upstream.catalog_time.get(book_id)
+        first = upstream.first_chapter_time.get(book_id)
+        end = upstream.document_time.get(chat_ids[book_id])
+        ttfb = f"{(first - begin) * 1000:.0f} ms" if begin and first else "-"
+        duration = f"{end - begin:.2f} s" if begin and end else "-"
+        rate = f"{(chapters or 0) / (end - begin):.1f}" if begin and end else "-"
+        size = f"{upstream.document_size.get(chat_ids[book_id], 0) / 1024:.0f} KB"
+        print(f"{book_id:<10} {status:<6} {chapters or 0:>6} {ttfb:>9} {duration:>9} {rate:>8} {size:>9}")
+    print(f"合计 {total} 个章节，耗时 {elapsed:.2f} s，吞吐量 {total / elapsed:.1f} 章节/s")
+    print(f"请求数 目录页 {upstream.requests['catalog']} 章节接口 {upstream.requests['chapter']} "
+          f"Telegram {upstream.requests['telegram']}，模拟错误 {upstream.errors}")
+    if peaks:
+        values = sorted(peaks.values())
+        print(f"下载进程内存峰值 平均 {sum(values) / len(values) / 1024 / 1024:.1f} MB "
+              f"最大 {values[-1] / 1024 / 1024:.1f} MB（{len(values)} 个进程）")
+
+    if args.stats:
+        print(bot.stats_text())
+
+    if args.keep:
+        print(f"临时目录: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if all(rows[book_id][0] == "已完成" for book_id in book_ids) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""
+章节清洗随机对比测试
+
+用标签片段随机拼接出章节内容（包括嵌套、残缺、相互交叠的标签），
+校验 public.clean_chapter 与原有的逐个正则替换输出完全一致：
+
+    python benchmarks/fuzz_cleaner.py [-n 用例数] [--seed 随机种子]
+"""
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_cleaner import legacy_clean, p  # noqa: E402
+
+# 各条规则涉及的标签和片段，随机拼接后容易出现嵌套和拆开的标签
+FRAGMENTS = [
+    "<", ">", "/", "/>", "\"", "\">", " ", "\n", "x", "正文",
+    "<p>", "</p>", "<b>", "</b>", "<i>", "<span", "<span a>", "span ", "sp", "an ",
+    "<p class=\"", "<p class=\"c\">", "p class=\"",
+    "<!--?xml", "<!--?xml v?>", "!--?xml",
+    "<link ", "<link a/>", "link ", "<meta ", "<meta a/>", "meta ",
+    "<h1 ", "<h1 a>", "h1 ", "<br/>", "br/>", "<br",
+    "<!DOCTYPE html ", "<!DOCTYPE html x>", "!DOCTYPE html", "<html ", "<html a>", "html ",
+]
+
+
+def random_chapter(rng):
+    body = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 12)))
+    return f"<header>h</header><article>{body}</article><footer>f</footer>"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="章节清洗随机对比测试")
+    parser.add_argument("-n", "--number", type=int, default=200000, help="随机用例数")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for i in range(args.number):
+        content = random_chapter(rng)
+        expected, actual = legacy_clean(content), p.clean_chapter(content)
+        if expected != actual:
+            print(f"第 {i} 个用例输出不一致\n输入: {content!r}\n原实现: {expected!r}\n单次替换: {actual!r}")
+            return 1
+    print(f"{args.number} 个随机用例输出一致")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+
+# 导入必要的模块
+import threading
+import time
+from datetime import datetime, timedelta
+
+from loguru import logger
+
+import public as p
+from cache import get_catalog_cache
+from storage import get_book_store
+
+
+def parse_hours(time_range: str):
+    """将 "18-22" 这样的时间范围转换为 (开始小时, 结束小时)，"false" 表示不限制，返回 None"""
+    if time_range == "false":
+        return None
+    start_hour, end_hour = time_range.split("-")
+    return int(start_hour), int(end_hour)
+
+
+def in_hours(hours, hour: int) -> bool:
+    start_hour, end_hour = hours
+    if start_hour <= end_hour:
+        return start_hour <= hour < end_hour
+    # 跨越零点的时间范围，如 22-6
+    return hour >= start_hour or hour < end_hour
+
+
+# 后台自动更新：定期分批检查未完结的书，有新章节时添加增量更新任务
+class AutoUpdater:
+    def __init__(self, db, config: dict, spider):
+        self.db = db
+        self.config = config
+        self.spider = spider
+        options = config.get("auto_update", {})
+        self.interval = options.get("interval", 600)  # 每批之间的间隔，单位为s
+        self.batch_size = options.get("batch_size", 20)  # 每批检查的书籍数量
+        self.check_delay = options.get("check_delay", 2)  # 每次检查目录之间的间隔，单位为s
+        self.min_age = options.get("min_age", 6 * 3600)  # 距离上次检查不足此时间的书不再检查，单位为s
+        # 运行时间：设置了服务时间范围时，在服务时间之外（低峰期）运行；否则按自动更新自己的时间范围运行
+        service_hours = parse_hours(config["time_range"])
+        if service_hours is not None:
+            self.hours = (service_hours[1], service_hours[0])
+        else:
+            self.hours = parse_hours(options.get("time_range", "false"))
+        self.is_running = True
+
+    def start(self):
+        logger.info(f"自动更新启动，运行时间: {'不限' if self.hours is None else '%d-%d点' % self.hours}")
+        threading.Thread(target=self.run, name="auto-update", daemon=True).start()
+
+    def stop(self):
+        self.is_running = False
+
+    def run(self):
+        while self.is_running:
+            now = datetime.utcnow() + timedelta(hours=8)
+            if self.hours is None or in_hours(self.hours, now.hour):
+                # noinspection PyBroadException
+                try:
+                    self.check_missing()
+                    self.check_batch()
+                except Exception as e:
+                    logger.exception(f"自动更新检查失败: {e}")
+            time.sleep(self.interval)
+
+    def check_batch(self):
+        # 优先检查最久没有检查过的书
+        curu = self.db.cursor()
+        curu.execute("SELECT id, last_cid FROM novels WHERE finished=0 AND status IN (?, ?, ?) "
+                     "AND (last_check IS NULL OR last_check < ?) ORDER BY last_check LIMIT ?",
+                     ("已完成", "已更新完成", "更新失败", time.time() - self.min_age, self.batch_size))
+        rows = curu.fetchall()
+        curu.close()
+        if len(rows) == 0:
+            logger.trace("没有需要自动更新的书籍")
+            return
+        logger.info(f"自动更新：开始检查{len(rows)}本未完结的书籍")
+        ua = (
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) "
+            "Chrome/118.0.0.0 "
+            "Safari/537.36"
+        )
+        added = 0
+        for book_id, last_cid in rows:
+            if not self.is_running:
+                break
+            url = p.page_url(book_id)
+            # noinspection PyBroadException
+            try:
+                # 使用目录缓存和条件请求，目录没有变化时开销很小
+                _, _, _, chapters, finished = p.get_fanqie(url, ua, get_catalog_cache(self.config))
+            except Exception as e:
+                logger.warning(f"自动更新：ID: {book_id} 获取目录失败: {e}")
+                chapters, finished = None, 0
+            self.db.write("UPDATE novels SET last_check=? WHERE id=?", (time.time(), book_id))
+            if chapters:
+                if chapters[-1].id != last_cid:
+                    if self.spider.add_update(book_id):
+                        added += 1
+                elif finished == 1:
+                    # 没有新章节但已完结，直接标记为完结
+                    self.db.write("UPDATE novels SET finished=1 WHERE id=?", (book_id,))
+                    logger.info(f"自动更新：ID: {book_id} 已完结")
+            time.sleep(self.check_delay)
+        logger.info(f"自动更新：检查完成，添加了{added}个更新任务")
+
+    def check_missing(self):
+        """有获取失败章节的书（包括已完结的书）添加更新任务，在更新开始时补全"""
+        added = 0
+        for book_id in get_book_store(self.config).missing_books(self.batch_size):
+            if self.spider.add_update(book_id):
+                added += 1
+        if added:
+            logger.info(f"自动更新：添加了{added}个补全章节的任务")
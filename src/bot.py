@@ -5,103 +5,146 @@ import re
 import telebot
 from loguru import logger
 import json
-import sqlite3
 from datetime import datetime, timedelta
 
 import queue
+import runpy
 import threading
 import multiprocessing
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 import time
-from fanqie_api import download, update
+from worker import init_worker, run_job
+from fetcher import AdaptivePacer, create_pacer_state
+from jobqueue import JobQueue
+from database import Database
+from autoupdate import AutoUpdater
+from webhook import WebhookServer
+from outbox import Outbox
+from storage import ENCODINGS, book_version, get_book_store, get_visible_name, package_book, package_legacy_book
+import public as p
+import metrics
+
+# 以下全局对象在 main() 中创建，导入本模块时不做任何初始化
+# 下载进程由 worker 模块启动，不需要这些对象
+config = None
+db = None
+bot = None
+outbox = None
+uploads = None
+spider = None
+start_hour = end_hour = None
+
+
+def load_config(path: str = "config.json"):
+    """加载配置文件并设置日志、保存目录和网络请求"""
+    global config, start_hour, end_hour
+    with open(path, "r", encoding='utf-8') as conf:
+        try:
+            config = json.load(conf)
+        except json.JSONDecodeError as conf_e:
+            raise json.JSONDecodeError("配置文件格式不正确", conf_e.doc, conf_e.pos)
+
+    # 默认编码格式，示例配置中的键名为 def_encoding
+    config.setdefault("encoding", config.get("def_encoding", "utf-8"))
+
+    os.makedirs(config["save_dir"], exist_ok=True)
 
-with open("config.json", "r", encoding='utf-8') as conf:
     try:
-        config = json.load(conf)
-    except json.JSONDecodeError as conf_e:
-        raise json.JSONDecodeError("配置文件格式不正确", conf_e.doc, conf_e.pos)
+        start_hour = int(config["time_range"].split("-")[0])
+        end_hour = int(config["time_range"].split("-")[1])
+    except ValueError:
+        pass
+
+    # 日志队列与进程池使用相同的启动方式，下载进程的日志也写入主进程的日志文件
+    logger.remove()
+    logger.add(config["log"]["filepath"], rotation=config["log"]["maxSize"], level=config["log"]["level"],
+               retention=config["log"]["backupCount"], encoding="utf-8", enqueue=True, context=pool_context())
+    logger.add(sys.stdout, level=config["log"]["console_level"], enqueue=True, context=pool_context())
+
+    # 主进程的自动更新也会请求目录页，与下载进程使用相同的网络请求设置
+    p.configure_http(config.get("http", {}))
+    return config
 
-os.makedirs(config["save_dir"], exist_ok=True)
 
-try:
-    start_hour = int(config["time_range"].split("-")[0])
-    end_hour = int(config["time_range"].split("-")[1])
-except ValueError:
-    pass
+def setup():
+    """连接数据库，创建机器人实例并注册命令"""
+    global db, bot, outbox, uploads
+    # 创建并连接数据库
+    db = Database(config["database"])
+    logger.debug("数据库连接成功")
 
-logger.remove()
-logger.add(config["log"]["filepath"], rotation=config["log"]["maxSize"], level=config["log"]["level"],
-           retention=config["log"]["backupCount"], encoding="utf-8", enqueue=True)
-logger.add(sys.stdout, level=config["log"]["console_level"], enqueue=True)
+    if config.get("bot_api_url"):
+        # 使用自建的 Bot API 服务器
+        telebot.apihelper.API_URL = config["bot_api_url"]
+    # 处理用户命令的线程数，webhook 模式下由 WebhookServer 的线程池处理，机器人本身不再开线程
+    bot = telebot.TeleBot(config["bot_token"], threaded=not use_webhook(), num_threads=handler_threads())
+    register_handlers()
+    # 所有发往 Telegram 的消息经过发送队列，遵守全局和每个会话的发送频率限制
+    outbox = Outbox(bot, config.get("outbox", {}))
 
-BOT_TOKEN = config["bot_token"]
+    # 上传大文件较慢，用户请求的发送放到单独的线程池中执行，不占用处理命令的线程
+    uploads = ThreadPoolExecutor(max_workers=max(int(config.get("upload_threads", 4)), 1),
+                                 thread_name_prefix="upload")
 
 
-# 创建并连接数据库
-db = sqlite3.connect(config["database"], check_same_thread=False)
-logger.debug("数据库连接成功")
+def use_webhook() -> bool:
+    return config.get("webhook", {}).get("enabled", False)
 
-# 创建一个黑名单表
-db.execute('''
-CREATE TABLE IF NOT EXISTS blacklist
-(chat_id TEXT PRIMARY KEY,
-unblock_time TEXT);
-''')
 
-# 创建一个任务状态表
-db.execute('''
-CREATE TABLE IF NOT EXISTS novels
-(id TEXT PRIMARY KEY,
-name TEXT,
-status TEXT,
-last_cid TEXT,
-last_update TEXT,
-finished INTEGER
-chat_id INTEGER);
-''')
+def handler_threads() -> int:
+    return max(int(config.get("handler_threads", 4)), 1)
 
-bot = telebot.TeleBot(BOT_TOKEN)
+
+def register_handlers():
+    bot.register_message_handler(send_welcome, commands=['start'])
+    bot.register_message_handler(send_help, commands=['help'])
+    bot.register_message_handler(preprocessing, commands=['add', 'query', 'download'])
+    bot.register_message_handler(name_search, commands=['name'])
+    bot.register_message_handler(my_history, commands=['my'])
+    bot.register_message_handler(send_stats, commands=['stats'])
+    bot.register_message_handler(clear_history, commands=['clear'])
+    # 翻页按钮需要在下载按钮之前匹配
+    bot.register_callback_query_handler(name_page, func=lambda call: call.data.startswith("name:"))
+    bot.register_callback_query_handler(callback_query, func=lambda call: True)
 
 
-@bot.message_handler(commands=['start'])
 def send_welcome(message):
-    bot.send_message(message.chat.id, """欢迎使用此机器人
+    outbox.send_message(message.chat.id, """欢迎使用此机器人
 此机器人用于下载番茄和七猫的小说
 (七猫暂未实现，敬请期待)
 请使用 /help 命令查看帮助
 """)
 
 
-@bot.message_handler(commands=['help'])
 def send_help(message):
-    bot.send_message(message.chat.id, f"""使用方法：
-添加下载任务: /add + 链接或ID
+    outbox.send_message(message.chat.id, f"""使用方法：
+添加下载任务: /add + 链接或ID + 编码格式（可选）
 查看所有下载任务: /query 
 查看指定下载任务: /query + 链接或ID
-下载已完成的任务: /download + 链接或ID
+下载已完成的任务: /download + 链接或ID + 编码格式（可选）
 搜索已完成的小说: /name + 小说名
 列出你的历史记录: /my
 清除你的历史记录: /clear
 e.g. /add 123456
+e.g. /add 123456 gbk
 
-编码格式: {config["encoding"]}
+支持的编码格式: {"、".join(ENCODINGS)}
+默认编码格式: {config["encoding"]}
 下载完成后会自动发送文件
 
 机器人目前仅支持txt格式
 如果需要下载epub格式，请使用电脑版程序下载
 """)
-    # 支持的编码格式：gbk、gb2312、utf-8
-    #  + 编码格式（可选）
 
 
 # 预处理发送的选项
-@bot.message_handler(commands=['add', 'query', 'download'])
 def preprocessing(message):
     logger.info(f"ChatID: {message.chat.id} 发送了命令: {message.text}")
     # 获取消息内容
     msg = message.text.split()
     category = msg[0].replace("/", "")
     url_id = None
+    encoding = config["encoding"]
     if category != "download":
         # 判断是否在限时范围内
         now = datetime.utcnow() + timedelta(hours=8)
@@ -111,18 +154,24 @@ def preprocessing(message):
         else:
             if not (start_hour <= now.hour < end_hour):
                 logger.debug(f"当前时间: {now.hour}点，不在时间范围内")
-                bot.send_message(message.chat.id, f"此服务只在{start_hour}点到{end_hour}点开放。")
+                outbox.send_message(message.chat.id, f"此服务只在{start_hour}点到{end_hour}点开放。")
                 return
             logger.debug(f"当前时间: {now.hour}点，请求通过")
-    if category == "add":
+    if category == "add" or category == "download":
         # 如果消息内容小于2或大于3，说明消息格式不正确
-        # if len(msg) < 2 or len(msg) > 3:
-        if len(msg) != 2:
-            bot.send_message(message.chat.id, "消息格式不正确，请使用 /help 命令查看帮助，注意空格")
+        if len(msg) < 2 or len(msg) > 3:
+            outbox.send_message(message.chat.id, "消息格式不正确，请使用 /help 命令查看帮助，注意空格")
             return
         else:
             # 获取链接或ID
             url_id = msg[1]
+        # 获取编码格式
+        if len(msg) == 3:
+            encoding = msg[2].lower()
+            # 如果编码格式不在列表中，说明编码格式不正确
+            if encoding not in ENCODINGS:
+                outbox.send_message(message.chat.id, "编码格式不正确，请使用 /help 命令查看帮助")
+                return
     elif category == "query":
         # 如果消息内容小于1或大于2，说明消息格式不正确
         if len(msg) == 1:
@@ -132,15 +181,8 @@ def preprocessing(message):
             # 获取链接或ID
             url_id = msg[1]
         else:
-            bot.send_message(message.chat.id, "消息格式不正确，请使用 /help 命令查看帮助，注意空格")
-            return
-    elif category == "download":
-        if len(msg) != 2:
-            bot.send_message(message.chat.id, "消息格式不正确，请使用 /help 命令查看帮助，注意空格")
+            outbox.send_message(message.chat.id, "消息格式不正确，请使用 /help 命令查看帮助，注意空格")
             return
-        else:
-            # 获取链接或ID
-            url_id = msg[1]
 
     # 获取链接或ID
     if url_id.isdigit():
@@ -155,7 +197,7 @@ def preprocessing(message):
                 book_id = re.search(r"page/(\d+)", url_id).group(1)
             except Exception:
                 logger.info("用户发送的链接转换失败")
-                bot.send_message(message.chat.id, "你发送的不是书籍ID或正确的链接。")
+                outbox.send_message(message.chat.id, "你发送的不是书籍ID或正确的链接。")
                 return
         elif 'changdunovel.com' in url_id:
             logger.debug("用户发送了移动端分享链接")
@@ -164,58 +206,52 @@ def preprocessing(message):
                 book_id = re.search(r"book_id=(\d+)&", url_id).group(1)
             except Exception:
                 logger.info("用户发送的链接转换失败")
-                bot.send_message(message.chat.id, "你发送的不是书籍ID或正确的链接。")
+                outbox.send_message(message.chat.id, "你发送的不是书籍ID或正确的链接。")
                 return
         else:
             logger.info("用户发送的内容无法识别")
-            bot.send_message(message.chat.id, "你发送的不是书籍ID或正确的链接。")
+            outbox.send_message(message.chat.id, "你发送的不是书籍ID或正确的链接。")
             return
 
     if category == "add":
-        # 获取编码格式
-        # try:
-        #     encoding = msg[2]
-        # except IndexError:
-        #     encoding = "utf-8"
-        # # 如果编码格式不在列表中，说明编码格式不正确
-        # if encoding not in ["gbk", "gb2312", "utf-8"]:
-        #     bot.send_message(message.chat.id, "编码格式不正确，请使用 /help 命令查看帮助")
-        #     return
-
-        add_task(book_id, message.chat.id)
+        add_task(book_id, message.chat.id, encoding)
     elif category == "query":
         query_task(book_id, message.chat.id)
     elif category == "download":
-        download(book_id, message.chat.id)
+        outbox.send_message(message.chat.id, text="正在发送，请稍等...", coalesce="sending")
+        download_async(book_id, message.chat.id, encoding)
 
 
-def add_task(book_id: str,  chat_id: int):
+def add_task(book_id: str,  chat_id: int, encoding: str):
     try:
         data = {
             "action": "add",
             "id": book_id,
+            "encoding": encoding,
         }
         res = api(data, chat_id)
         if res["message"] == "此书籍已添加到下载队列":
-            bot.send_message(chat_id, f"恭喜，此书籍已成功添加到下载队列\n"
-                                      f"书籍ID: {book_id}\n"
-                                      f"位置: {res['position']}\n"
-                                      f"状态: {res['status']}")
+            outbox.send_message(chat_id, f"恭喜，此书籍已成功添加到下载队列\n"
+                                         f"书籍ID: {book_id}\n"
+                                         f"位置: {res['position']}\n"
+                                         f"状态: {res['status']}", coalesce=f"status:{book_id}")
         elif res["message"] == "finished":
             keyboard = telebot.types.InlineKeyboardMarkup()
-            button = telebot.types.InlineKeyboardButton("点击下载", callback_data=book_id)
+            # 非默认编码时在按钮中带上编码格式
+            callback_data = book_id if encoding == config["encoding"] else f"{book_id} {encoding}"
+            button = telebot.types.InlineKeyboardButton("点击下载", callback_data=callback_data)
             keyboard.add(button)
-            bot.send_message(chat_id, f"此书籍已存在且已完结，请点击下方按钮下载", reply_markup=keyboard)
+            outbox.send_message(chat_id, f"此书籍已存在且已完结，请点击下方按钮下载", reply_markup=keyboard)
         else:
-            bot.send_message(chat_id, f"{res['message']}\n"
-                                      f"书籍ID: {book_id}\n"
-                                      f"位置: {res['position']}\n"
-                                      f"状态: {res['status']}\n"
-                                      f"上次更新: {res['last_update']}")
+            outbox.send_message(chat_id, f"{res['message']}\n"
+                                         f"书籍ID: {book_id}\n"
+                                         f"位置: {res['position']}\n"
+                                         f"状态: {res['status']}\n"
+                                         f"上次更新: {res['last_update']}", coalesce=f"status:{book_id}")
 
     except BaseException as e:
         # 如果发生异常，发送异常信息
-        bot.send_message(chat_id, f"添加任务失败：{e}")
+        outbox.send_message(chat_id, f"添加任务失败：{e}")
 
 
 def query_task(book_id: str,  chat_id: int):
@@ -226,17 +262,17 @@ def query_task(book_id: str,  chat_id: int):
         }
         res = api(data, chat_id)
         if res["exists"] is False:
-            bot.send_message(chat_id, f"此书籍不存在\n"
-                                      f"书籍ID: {book_id} ")
+            outbox.send_message(chat_id, f"此书籍不存在\n"
+                                         f"书籍ID: {book_id} ")
         else:
-            bot.send_message(chat_id, f"状态:{res['status']}\n"
-                                      f"书籍ID: {book_id}\n"
-                                      f"位置: {res['position']}\n"
-                                      f"上次更新: {res['last_update']}")
+            outbox.send_message(chat_id, f"状态:{res['status']}\n"
+                                         f"书籍ID: {book_id}\n"
+                                         f"位置: {res['position']}\n"
+                                         f"上次更新: {res['last_update']}", coalesce=f"status:{book_id}")
 
     except BaseException as e:
         # 如果发生异常，发送异常信息
-        bot.send_message(chat_id, f"查询失败：{e}")
+        outbox.send_message(chat_id, f"查询失败：{e}")
 
 
 def query_all(chat_id: int):
@@ -246,73 +282,210 @@ def query_all(chat_id: int):
     rows = curb.fetchall()
     curb.close()
     if len(rows) == 0:
-        bot.send_message(chat_id, "没有未完成的任务")
+        outbox.send_message(chat_id, "没有未完成的任务")
     else:
         tasks = ""
         for row in rows:
             tasks += f"ID: {row[0]} 状态: {row[1]}\n"
-        bot.send_message(chat_id, tasks)
+        outbox.send_message(chat_id, tasks)
+
+
+def get_file_id(book_id, encoding, version):
+    curf = db.cursor()
+    curf.execute("SELECT file_id FROM documents WHERE id=? AND encoding=? AND version=?", (book_id, encoding, version))
+    row = curf.fetchone()
+    curf.close()
+    return row[0] if row is not None else None
+
+
+def save_file_id(book_id, encoding, version, file_id):
+    # 每本书每种编码只保留最新版本的文件ID，版本变化后旧的文件ID自动失效
+    if file_id is None:
+        return
+    db.write("INSERT OR REPLACE INTO documents (id, encoding, version, file_id) VALUES (?, ?, ?, ?)",
+             (book_id, encoding, version, file_id))
+
+
+def add_subscriber(book_id, chat_id, encoding):
+    # 同一本书的所有请求者都挂到同一个任务上，任务结束后按各自的编码一并发送，并记入各自的下载历史
+    if chat_id is None:
+        return
+    db.write("INSERT OR REPLACE INTO subscribers (book_id, chat_id, encoding) VALUES (?, ?, ?)",
+             (book_id, chat_id, encoding))
+    db.write("INSERT OR IGNORE INTO history (chat_id, book_id) VALUES (?, ?)", (chat_id, book_id))
+
+
+def pop_subscribers(book_id):
+    """取出并清空等待此书的所有用户，按订阅顺序返回 (ChatID, 编码格式)"""
+    curs = db.cursor()
+    curs.execute("SELECT chat_id, encoding FROM subscribers WHERE book_id=? ORDER BY ROWID", (book_id,))
+    chat_ids = [(row[0], row[1] or config["encoding"]) for row in curs.fetchall()]
+    curs.close()
+    if chat_ids:
+        db.write("DELETE FROM subscribers WHERE book_id=?", (book_id,))
+    return chat_ids
+
+
+def download_async(book_id, chat_id, encoding=None, caption=None):
+    """在上传线程池中发送文件，立即返回"""
+    def done(future):
+        e = future.exception()
+        if e is not None:
+            logger.error(f"ID: {book_id} 发送给 ChatID: {chat_id} 失败: {e}")
+    uploads.submit(download, book_id, chat_id, encoding, caption).add_done_callback(done)
 
 
-def download(book_id, chat_id):
+def download(book_id, chat_id, encoding=None, caption=None):
+    encoding = encoding or config["encoding"]
     curd = db.cursor()
-    curd.execute("SELECT name FROM novels WHERE id=? AND status NOT IN ('失败', '进行中', '等待中')", (book_id, ))
+    curd.execute("SELECT name, last_cid FROM novels WHERE id=? AND status NOT IN ('失败', '进行中', '等待中')",
+                 (book_id, ))
     row = curd.fetchone()
     curd.close()
     if row is None:
-        bot.send_message(chat_id, f"抱歉，你想要下载的小说不存在。\n"
-                                  f"请检查你的链接或ID是否正确，或者稍后再试。")
+        outbox.send_message(chat_id, f"抱歉，你想要下载的小说不存在。\n"
+                                     f"请检查你的链接或ID是否正确，或者稍后再试。")
         return
-    title = row[0]
-    file_path = os.path.join(config["save_dir"],
-                             config["filename_format"].format(title=title, book_id=book_id))
+    title, last_cid = row
+    # 补全过章节的书内容有变化，版本以存储中的为准
+    version = book_version(config, book_id) or last_cid
+    # 如果当前版本已用此编码上传过，直接使用文件ID发送，分卷发送过的为以空格分隔的多个文件ID
+    file_id = get_file_id(book_id, encoding, version)
+    if file_id is not None:
+        try:
+            file_ids = file_id.split()
+            for i, volume_id in enumerate(file_ids):
+                outbox.send_document(chat_id, volume_id, caption=document_caption(caption, i, len(file_ids))).result()
+            return
+        except telebot.apihelper.ApiTelegramException as e:
+            logger.warning(f"ID: {book_id} 使用文件ID发送失败，重新上传: {e}")
+    visible_name = get_visible_name(config, title, book_id, encoding)
     try:
-        with open(file_path, "rb") as f:
-            bot.send_message(chat_id, text="正在发送，请稍等...")
-            bot.send_document(chat_id, f)
+        # 从存储中导出指定编码的文件，超过上传限制时压缩或分卷
+        paths = package_book(config, book_id, encoding, visible_name)
+        if paths is None:
+            # 旧版本保存的书不在存储中，使用原有的 txt 文件，按需转换编码和压缩
+            legacy_path = os.path.join(config["save_dir"],
+                                       config["filename_format"].format(title=title, book_id=book_id))
+            paths = package_legacy_book(config, book_id, legacy_path, encoding, visible_name)
+        if not paths:
+            outbox.send_message(chat_id, "抱歉，小说文件压缩后仍超过发送大小限制，无法发送。\n"
+                                         "请向管理员反馈。")
+            return
+        file_ids = []
+        for i, path in enumerate(paths):
+            with open(path, "rb") as f:
+                with metrics.UPLOAD_SECONDS.time():
+                    # 等待发送完成后再关闭文件
+                    document = outbox.send_document(chat_id, f, caption=document_caption(caption, i, len(paths)),
+                                                    visible_file_name=document_name(visible_name, path, i, len(paths))
+                                                    ).result()
+            file_ids.append(document.document.file_id)
+        save_file_id(book_id, encoding, version, " ".join(file_ids))
     except FileNotFoundError:
-        bot.send_message(chat_id, f"抱歉，未找到小说文件。\n"
-                                  f"文件不存在，请向管理员反馈。")
+        outbox.send_message(chat_id, f"抱歉，未找到小说文件。\n"
+                                     f"文件不存在，请向管理员反馈。")
+
+
+def document_caption(caption, index: int, count: int):
+    """分卷发送时在说明后加上卷号"""
+    if count == 1:
+        return caption
+    return f"{caption or ''}（{index + 1}/{count}）"
+
+
+def document_name(visible_name: str, path: str, index: int, count: int) -> str:
+    """压缩后的文件使用 zip 扩展名，分卷时加上卷号"""
+    if not path.endswith(".zip"):
+        return visible_name
+    name = os.path.splitext(visible_name)[0]
+    return f"{name}.zip" if count == 1 else f"{name}_{index + 1}.zip"
+
+
+# 每个用户最近一次搜索的关键词，用于翻页
+name_searches = {}
+
+
+def search_names(name: str, page: int):
+    """在书名全文索引中搜索已完成的小说，按相关度排序，返回当前页结果和是否还有下一页"""
+    page_size = config.get("search_page_size", 10)
+    curn = db.cursor()
+    if len(name) >= 3:
+        # 三元组分词至少需要3个字符，用双引号包裹作为短语查询
+        curn.execute("SELECT novels.id, novels.name FROM novels_fts JOIN novels ON novels.rowid = novels_fts.rowid "
+                     "WHERE novels_fts MATCH ? AND novels.status NOT IN ('失败', '进行中', '等待中') "
+                     "ORDER BY novels_fts.rank LIMIT ? OFFSET ?",
+                     ('"' + name.replace('"', '""') + '"', page_size + 1, page * page_size))
+    else:
+        # 过短的关键词无法使用索引，按书名长度排序，越短越接近
+        curn.execute("SELECT id, name FROM novels WHERE name LIKE ? AND status NOT IN ('失败', '进行中', '等待中') "
+                     "ORDER BY length(name) LIMIT ? OFFSET ?",
+                     (f"%{name}%", page_size + 1, page * page_size))
+    rows = curn.fetchall()
+    curn.close()
+    return rows[:page_size], len(rows) > page_size
+
+
+def name_keyboard(rows, page: int, has_more: bool):
+    # 使用按钮请用户选择
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    for row in rows:
+        button = telebot.types.InlineKeyboardButton(row[1], callback_data=row[0])
+        keyboard.add(button)
+    # 翻页按钮
+    buttons = []
+    if page > 0:
+        buttons.append(telebot.types.InlineKeyboardButton("上一页", callback_data=f"name:{page - 1}"))
+    if has_more:
+        buttons.append(telebot.types.InlineKeyboardButton("下一页", callback_data=f"name:{page + 1}"))
+    if buttons:
+        keyboard.row(*buttons)
+    return keyboard
 
 
-@bot.message_handler(commands=['name'])
 def name_search(message):
     msg = message.text.split()
     if len(msg) != 2:
-        bot.send_message(message.chat.id, "消息格式不正确，请使用 /help 命令查看帮助，注意空格")
+        outbox.send_message(message.chat.id, "消息格式不正确，请使用 /help 命令查看帮助，注意空格")
         return
     name = msg[1]
-    curn = db.cursor()
-    curn.execute("SELECT id, name FROM novels WHERE name LIKE ? AND status NOT IN ('失败', '进行中', '等待中')", (f"%{name}%",))
-    rows = curn.fetchall()
-    curn.close()
+    rows, has_more = search_names(name, 0)
     if len(rows) == 0:
-        bot.send_message(message.chat.id, "没有找到相关小说")
+        outbox.send_message(message.chat.id, "没有找到相关小说")
     else:
-        # 使用按钮请用户选择
-        keyboard = telebot.types.InlineKeyboardMarkup()
-        for row in rows:
-            button = telebot.types.InlineKeyboardButton(row[1], callback_data=row[0])
-            keyboard.add(button)
-        bot.send_message(message.chat.id, "请选择你要下载的小说：", reply_markup=keyboard)
+        name_searches[message.chat.id] = name
+        outbox.send_message(message.chat.id, "请选择你要下载的小说：", reply_markup=name_keyboard(rows, 0, has_more))
+
+
+def name_page(call):
+    name = name_searches.get(call.message.chat.id)
+    if name is None:
+        bot.answer_callback_query(call.id, "搜索已过期，请重新搜索")
+        return
+    page = int(call.data.split(":")[1])
+    rows, has_more = search_names(name, page)
+    bot.answer_callback_query(call.id)
+    outbox.edit_message_reply_markup(call.message.chat.id, call.message.message_id,
+                                     reply_markup=name_keyboard(rows, page, has_more))
 
 
-@bot.callback_query_handler(func=lambda call: True)
 def callback_query(call):
     bot.answer_callback_query(call.id, "正在发送，请稍候...")
-    bot.send_message(call.message.chat.id, text="正在发送，请稍等...")
-    download(call.data, call.message.chat.id)
+    outbox.send_message(call.message.chat.id, text="正在发送，请稍等...", coalesce="sending")
+    # 按钮数据为书籍ID，非默认编码时后跟编码格式
+    data = call.data.split()
+    download_async(data[0], call.message.chat.id, data[1] if len(data) > 1 else None)
 
 
-@bot.message_handler(commands=['my'])
 def my_history(message):
     curh = db.cursor()
-    curh.execute("SELECT id, name FROM novels WHERE chat_id=? AND status NOT IN ('失败', '进行中', '等待中') ORDER BY ROWID",
+    curh.execute("SELECT novels.id, novels.name FROM history JOIN novels ON novels.id = history.book_id "
+                 "WHERE history.chat_id=? AND novels.status NOT IN ('失败', '进行中', '等待中') ORDER BY history.ROWID",
                  (message.chat.id,))
     rows = curh.fetchall()
     curh.close()
     if len(rows) == 0:
-        bot.send_message(message.chat.id, "没有找到你曾经下载完成的小说")
+        outbox.send_message(message.chat.id, "没有找到你曾经下载完成的小说")
     else:
         text = ""
         # 使用按钮请用户选择
@@ -322,132 +495,219 @@ def my_history(message):
             button = telebot.types.InlineKeyboardButton(row[1], callback_data=row[0])
             keyboard.add(button)
         text += "请点击下方按钮下载"
-        bot.send_message(message.chat.id, text, reply_markup=keyboard)
+        outbox.send_message(message.chat.id, text, reply_markup=keyboard)
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    if seconds == float("inf"):
+        return "很长"
+    if seconds < 0.001:
+        return f"{seconds * 1000000:.0f}µs"
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.1f}s"
+
+
+def stats_text():
+    metrics.REGISTRY.render()  # 更新队列长度等即时数据
+    lines = [f"队列: 优先 {metrics.QUEUE_DEPTH.get(lane='fast'):.0f} 普通 {metrics.QUEUE_DEPTH.get(lane='normal'):.0f} "
+             f"进行中 {metrics.JOBS_RUNNING.get():.0f}"]
+    jobs = metrics.JOB_SECONDS.merged()[-1]
+    failed = sum(metrics.JOB_SECONDS.count(mode=mode, result="failed") for mode in ("download", "update"))
+    lines.append(f"任务: {jobs} 个 失败 {failed} 个 平均 {format_seconds(metrics.JOB_SECONDS.mean())} "
+                 f"p95 {format_seconds(metrics.JOB_SECONDS.quantile(0.95))}")
+    lines.append(f"章节: 写入 {metrics.CHAPTERS_WRITTEN.total():.0f} 个 "
+                 f"重试 {metrics.CHAPTER_RETRIES.total():.0f} 次 跳过 {metrics.CHAPTER_FAILURES.total():.0f} 个")
+    hits, misses = metrics.CHAPTER_CACHE.get(result="hit"), metrics.CHAPTER_CACHE.get(result="miss")
+    if hits + misses:
+        lines.append(f"章节缓存命中率: {hits / (hits + misses):.1%}")
+    # 各阶段的平均耗时和 p95
+    for name, histogram in (("目录页", metrics.CATALOG_SECONDS), ("章节接口", metrics.CHAPTER_SECONDS),
+                            ("清洗", metrics.CLEAN_SECONDS), ("写入", metrics.STORE_SECONDS),
+                            ("导出", metrics.EXPORT_SECONDS), ("上传", metrics.UPLOAD_SECONDS)):
+        lines.append(f"{name}: 平均 {format_seconds(histogram.mean())} p95 {format_seconds(histogram.quantile(0.95))}")
+    return "\n".join(lines)
+
+
+def send_stats(message):
+    # 仅管理员可用
+    if message.chat.id not in config.get("admins", []):
+        return
+    outbox.send_message(message.chat.id, stats_text())
 
 
-@bot.message_handler(commands=['clear'])
 def clear_history(message):
-    curc = db.cursor()
-    curc.execute("UPDATE novels SET chat_id=NULL WHERE chat_id=?", (message.chat.id,))
-    db.commit()
-    curc.close()
-    bot.send_message(message.chat.id, "已清除你的下载历史记录")
+    db.write("DELETE FROM history WHERE chat_id=?", (message.chat.id,))
+    outbox.send_message(message.chat.id, "已清除你的下载历史记录")
 
 
 def book_id_to_url(book_id):
-    return 'https://fanqienovel.com/page/' + book_id
+    return p.page_url(book_id)
 
 
 def url_to_book_id(url):
     return re.search(r"page/(\d+)", url).group(1)
 
 
+def pool_context():
+    """下载进程的启动方式，优先使用 forkserver：子进程不继承主进程的数据库连接、线程和锁"""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        # 预先导入下载模块，之后的进程从已导入的服务进程 fork 出来；
+        # 子进程仍会重新导入入口模块（__mp_main__），入口为只含启动代码的 main.py
+        context.set_forkserver_preload(["worker"])
+        # 服务进程不沿用主进程的 sys.path，导入失败时预加载会被静默忽略；服务进程继承环境变量，通过 PYTHONPATH 指定
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        paths = [path for path in os.environ.get("PYTHONPATH", "").split(os.pathsep) if path]
+        if src_dir not in paths:
+            os.environ["PYTHONPATH"] = os.pathsep.join([src_dir] + paths)
+        return context
+    return multiprocessing.get_context()
+
+
 # 定义爬虫类
 class Spider:
     def __init__(self):
-        # 初始化URL队列
-        self.url_queue = queue.Queue()
+        # 初始化任务队列，队列中保存书籍ID
+        scheduler = config.get("scheduler", {})
+        self.job_queue = JobQueue(fair_share=scheduler.get("fair_share", True),
+                                  fast_lane=scheduler.get("update_priority", True),
+                                  fast_burst=scheduler.get("fast_burst", 5))
+        self.small_job_chapters = scheduler.get("small_job_chapters", 300)
         # 设置运行状态为True
         self.is_running = True
-
-    @staticmethod
-    def crawl(url):
+        # 常驻的下载进程池，在start()中创建
+        self.pool = None
+        self.pacer_state = None
+        self.add_lock = threading.Lock()
+        metrics.REGISTRY.add_collector(self.update_metrics)
+
+    def update_metrics(self):
+        metrics.QUEUE_DEPTH.set(self.job_queue.sizes[JobQueue.FAST], lane="fast")
+        metrics.QUEUE_DEPTH.set(self.job_queue.sizes[JobQueue.NORMAL], lane="normal")
+        if self.pacer_state is not None:
+            metrics.PACER_RATE.set(self.pacer_state[AdaptivePacer.RATE])
+
+    def crawl(self, url):
+        """在进程池中运行任务并保存结果，由调用者发送给订阅者"""
         try:
             logger.info(f"Crawling for URL: {url}")
             book_id = url_to_book_id(url)
             curm = db.cursor()
-            curm.execute("SELECT finished, chat_id FROM novels WHERE id=?", (book_id,))
+            curm.execute("SELECT finished FROM novels WHERE id=?", (book_id,))
             row = curm.fetchone()
-            chat_id = row[1]
-            # 根据完结信息判断模式
-            if row is not None and row[0] == 0:
+            # 根据完结信息判断模式，已完结但有待补全章节的书也使用增量更新模式
+            if row is not None and (row[0] == 0 or get_book_store(config).missing(book_id)):
                 # 如果已有信息，使用增量更新模式
-                with Pool(processes=1) as pool:
-                    logger.info(f"ID:{book_id} 使用增量更新模式")
-                    curm.execute("SELECT name, last_cid FROM novels WHERE id=?", (book_id,))
-                    row = curm.fetchone()
-                    title = row[0]
-                    last_cid = row[1]
-                    file_path = os.path.join(config["save_dir"],
-                                             config["filename_format"].format(title=title, book_id=book_id))
-                    logger.debug(f"名称: {title} 上次更新章节: {last_cid} 生成路径: {file_path} ID: {book_id} 开始更新")
-                    res = pool.apply(update, (url, config["encoding"], last_cid, file_path, config, chat_id))  # 运行函数
-                    # 获取任务和小说信息
-                    status, last_cid, finished = res
-                    # 写入数据库
-                    curm.execute("UPDATE novels SET last_cid=?, last_update=?, finished=? WHERE id=?",
-                                 (last_cid, datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), finished, book_id))
-                    db.commit()
-                    curm.close()
-                    if status == "completed":
-                        return "completed"
-                    else:
-                        return "failed"
+                logger.info(f"ID:{book_id} 使用增量更新模式")
+                curm.execute("SELECT name, last_cid FROM novels WHERE id=?", (book_id,))
+                row = curm.fetchone()
+                title = row[0]
+                last_cid = row[1]
+                logger.debug(f"名称: {title} 上次更新章节: {last_cid} ID: {book_id} 开始更新")
+                job = {"mode": "update", "url": url, "start_id": last_cid}
+                res, snapshot = self.pool.apply(run_job, (job,))  # 交给进程池运行
+                metrics.REGISTRY.merge(snapshot)
+                # 获取任务和小说信息
+                status, last_cid, finished, chapter_count = res
+                # 写入数据库
+                db.write("UPDATE novels SET last_cid=?, last_update=?, finished=?, "
+                         "chapters=COALESCE(?, chapters) WHERE id=?",
+                         (last_cid, datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), finished, chapter_count, book_id))
+                curm.close()
+                if status in ("completed", "latest"):
+                    return status
+                else:
+                    return "failed"
             else:
                 # 如果没有或者未成功，则普通下载
-                with Pool(processes=1) as pool:
-                    logger.info(f"ID:{book_id} 使用普通下载模式")
-                    logger.debug(f"ID: {book_id} 开始下载")
-                    res = pool.apply(download, (url, config["encoding"], config, chat_id))  # 运行函数
-                    # 获取任务和小说信息
-                    status, name, last_cid, finished = res
-                    # 写入数据库
-                    curm.execute("UPDATE novels SET name=?, last_cid=?, last_update=?, finished=? WHERE id=?",
-                                 (name, last_cid, datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), finished, book_id))
-                    db.commit()
-                    curm.close()
-                    if status == "completed":
-                        return "True"
-                    else:
-                        return "False"
+                logger.info(f"ID:{book_id} 使用普通下载模式")
+                logger.debug(f"ID: {book_id} 开始下载")
+                job = {"mode": "download", "url": url}
+                res, snapshot = self.pool.apply(run_job, (job,))  # 交给进程池运行
+                metrics.REGISTRY.merge(snapshot)
+                # 获取任务和小说信息
+                status, name, last_cid, finished, chapter_count = res
+                # 写入数据库
+                db.write("UPDATE novels SET name=?, last_cid=?, last_update=?, finished=?, "
+                         "chapters=COALESCE(?, chapters) WHERE id=?",
+                         (name, last_cid, datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), finished,
+                          chapter_count, book_id))
+                curm.close()
+                if status == "completed":
+                    return "True"
+                else:
+                    return "False"
         except Exception as e:
-            print(f"Error: {e}")
+            logger.exception(f"URL: {url} 任务出错: {e}")
             return "False"
 
     def worker(self):
         # 当运行状态为True时，持续工作
         while self.is_running:
             try:
-                # 从URL队列中获取URL
-                url = self.url_queue.get(timeout=1)
-                book_id = url_to_book_id(url)
-                curn = db.cursor()
-                logger.debug(f"ID: {book_id} 开始任务")
-                curn.execute("UPDATE novels SET status=? WHERE id=?", ("进行中", book_id))
-                db.commit()
-                logger.debug(f"ID: {book_id} 状态更新为进行中")
-                status = Spider.crawl(url)
-                # 调用爬虫函数爬取URL，如果出错则标记为失败并跳过这个任务进行下一个
-                if status == "True":
-                    curn.execute("UPDATE novels SET status=? WHERE id=?", ("已完成", book_id))
-                    db.commit()
-                    logger.debug(f"ID: {book_id} 状态更新为已完成")
-                elif status == "completed":
-                    curn.execute("UPDATE novels SET status=? WHERE id=?", ("已更新完成", book_id))
-                    db.commit()
-                    logger.debug(f"ID: {book_id} 状态更新为已更新完成")
-                elif status == "failed":
-                    curn.execute("UPDATE novels SET status=? WHERE id=?", ("更新失败", book_id))
-                    db.commit()
-                    logger.debug(f"ID: {book_id} 状态更新为更新失败")
-                else:
-                    curn.execute("UPDATE novels SET status=? WHERE id=?", ("失败", book_id))
-                    db.commit()
-                    logger.debug(f"ID: {book_id} 状态更新为失败")
-                curn.close()
-                # 完成任务后，标记任务为完成状态
-                self.url_queue.task_done()
-                logger.debug(f"ID: {book_id} 任务结束 结束状态: {status}")
+                # 从任务队列中获取书籍ID
+                book_id = self.job_queue.get(timeout=1)
             except queue.Empty:
                 time.sleep(5)
                 logger.trace("队列为空，等待5秒")
                 continue
+            url = book_id_to_url(book_id)
+            logger.debug(f"ID: {book_id} 开始任务 ({threading.current_thread().name})")
+            self.set_status(book_id, "进行中")
+            metrics.JOBS_RUNNING.inc()
+            start = time.perf_counter()
+            # 调用爬虫函数爬取URL，如果出错则标记为失败并跳过这个任务进行下一个
+            status = self.crawl(url)
+            metrics.JOBS_RUNNING.inc(-1)
+            metrics.JOB_SECONDS.observe(time.perf_counter() - start,
+                                        mode="update" if status in ("completed", "latest", "failed") else "download",
+                                        result="ok" if status in ("True", "completed", "latest") else "failed")
+            caption = None
+            if status == "True":
+                result, caption = "已完成", "小说下载完成"
+            elif status == "completed":
+                result, caption = "已更新完成", "小说更新完成"
+            elif status == "latest":
+                result, caption = "已更新完成", "小说已经是最新章节，无需更新"
+            elif status == "failed":
+                result = "更新失败"
+            else:
+                result = "失败"
+            # 更新状态和取出订阅者需要与添加任务互斥，保证任务结束前订阅的用户都能收到结果
+            with self.add_lock:
+                self.set_status(book_id, result)
+                subscribers = pop_subscribers(book_id)
+            self.deliver(book_id, subscribers, caption)
+            logger.debug(f"ID: {book_id} 任务结束 结束状态: {status}")
+
+    @staticmethod
+    def deliver(book_id, subscribers, caption):
+        """把任务结果发送给所有订阅者，每种编码的文件只上传一次，caption 为 None 表示任务失败"""
+        for chat_id, encoding in subscribers:
+            # noinspection PyBroadException
+            try:
+                if caption is not None:
+                    download(book_id, chat_id, encoding, caption=caption)
+                else:
+                    outbox.send_message(chat_id, f"抱歉，你提交的小说（ID：{book_id}）下载失败。\n"
+                                                 f"请检查你的链接或ID是否正确，或者稍后再试。\n"
+                                                 f"（部分小说由于版权原因无法下载）")
+            except Exception as e:
+                logger.warning(f"ID: {book_id} 发送给 ChatID: {chat_id} 失败: {e}")
+        if subscribers:
+            logger.info(f"ID: {book_id} 已发送给{len(subscribers)}个订阅者")
+
+    @staticmethod
+    def set_status(book_id, status):
+        db.write("UPDATE novels SET status=? WHERE id=?", (status, book_id))
+        logger.debug(f"ID: {book_id} 状态更新为{status}")
 
     def start(self):
         logger.info("爬虫工作启动")
         # 启动时检查数据库中是否有未完成的任务
         curc = db.cursor()
-        curc.execute("SELECT id FROM novels WHERE status IN (?, ?, ?) ORDER BY ROWID",
+        curc.execute("SELECT id, status, chat_id, chapters FROM novels WHERE status IN (?, ?, ?) ORDER BY ROWID",
                      ("进行中", "等待中", "等待更新中"))
         rows = curc.fetchall()
         curc.close()
@@ -457,37 +717,74 @@ class Spider:
             logger.warning(f"数据库中有{len(rows)}个未完成的任务")
         # 有则添加到队列
         for row in rows:
-            self.url_queue.put(book_id_to_url(row[0]))
+            self.enqueue(row[0], row[2], row[1] == "等待更新中", row[3])
             logger.debug(f"ID: {row[0]} 已添加到队列")
-        # 启动工作线程
-        threading.Thread(target=self.worker, daemon=True).start()
-
-    def add_url(self, book_id, chat_id):
+        workers = max(int(config.get("workers", 1)), 1)
+        # 创建常驻进程池并预先初始化，进程处理一定数量的任务后自动重建以释放内存
+        # 所有下载进程共用一个自适应限速器
+        context = pool_context()
+        self.pacer_state = create_pacer_state(config, context)
+        self.pool = context.Pool(processes=workers, initializer=init_worker,
+                                 initargs=(config, self.pacer_state, logger),
+                                 maxtasksperchild=config.get("max_tasks_per_child", 20))
+        # 启动工作线程，每个线程同时处理一本书
+        for i in range(workers):
+            threading.Thread(target=self.worker, name=f"worker-{i + 1}", daemon=True).start()
+        logger.info(f"已启动{workers}个工作线程")
+
+    def enqueue(self, book_id, chat_id, is_update, chapters):
+        # 增量更新和目录章节数较少的书进入快速通道
+        fast = is_update or (chapters is not None and chapters <= self.small_job_chapters)
+        return self.job_queue.put(book_id, chat_id, fast)
+
+    def add_url(self, book_id, chat_id, encoding=None):
+        # 查询与入队需要原子完成，避免并发添加同一本书时重复入队
+        with self.add_lock:
+            return self._add_url(book_id, chat_id, encoding or config["encoding"])
+
+    def _add_url(self, book_id, chat_id, encoding):
         logger.debug(f"尝试添加ID: {book_id} 到队列")
         cura = db.cursor()
-        cura.execute("SELECT status, finished FROM novels WHERE id=?", (book_id,))
+        cura.execute("SELECT status, finished, chapters FROM novels WHERE id=?", (book_id,))
         row = cura.fetchone()
         if row is None or row[0] == "失败":
-            self.url_queue.put(book_id_to_url(book_id))
-            logger.debug(f"ID: {book_id} 已添加到队列")
-            cura.execute("INSERT OR REPLACE INTO novels (id, status, chat_id) VALUES (?, ?, ?)",
-                         (book_id, "等待中", chat_id))
-            db.commit()
+            # 重新下载失败的书时沿用上次获取的目录章节数
+            chapters = row[2] if row is not None else None
             cura.close()
+            # 先写入状态再入队，保证工作线程取到任务时能读到任务信息
+            db.write("INSERT OR REPLACE INTO novels (id, status, chat_id, chapters) VALUES (?, ?, ?, ?)",
+                     (book_id, "等待中", chat_id, chapters))
+            add_subscriber(book_id, chat_id, encoding)
+            self.enqueue(book_id, chat_id, False, chapters)
+            logger.debug(f"ID: {book_id} 已添加到队列")
             return "此书籍已添加到下载队列"
         else:
             # 如果已存在，检查书籍是否已完结
             if row[1] == 1:
+                chapters = row[2]
+                cura.execute("SELECT last_update FROM novels WHERE id=?", (book_id,))
+                last_update = cura.fetchone()[0]
                 cura.close()
+                # 已完结但有获取失败的章节时，添加更新任务补全，补全后一并发送；与更新相同，3小时内不重复尝试
+                recent = last_update is not None and \
+                    datetime.now() - datetime.strptime(last_update, '%Y-%m-%d %H:%M:%S.%f') < timedelta(hours=3)
+                if not recent and get_book_store(config).missing(book_id):
+                    db.write("UPDATE novels SET status=?, chat_id=? WHERE id=?", ("等待更新中", chat_id, book_id))
+                    add_subscriber(book_id, chat_id, encoding)
+                    self.enqueue(book_id, chat_id, True, chapters)
+                    logger.debug(f"ID: {book_id} 已完结，有待补全的章节，已添加到队列 (等待更新中)")
+                    return "此书籍已完结，有未获取到的章节，正在尝试补全"
                 logger.debug(f"ID: {book_id} 已存在且已完结")
                 # 如果已完结，返回提示信息
                 return "finished"
             elif row[0] == "等待中" or row[0] == "进行中" or row[0] == "等待更新中":
                 cura.close()
-                logger.debug(f"ID: {book_id} 已存在且正在下载")
-                # 如果正在下载，返回提示信息
-                return "此书籍已存在且正在下载"
+                # 如果正在下载，加入订阅者，任务完成后一并发送
+                add_subscriber(book_id, chat_id, encoding)
+                logger.debug(f"ID: {book_id} 已存在且正在下载，ChatID: {chat_id} 已加入订阅")
+                return "此书籍已存在且正在下载，完成后会一并发送给你"
             else:
+                chapters = row[2]
                 cura.execute("SELECT last_update FROM novels WHERE id=?", (book_id,))
                 row = cura.fetchone()
                 last_update = datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f')
@@ -499,23 +796,35 @@ class Spider:
                     return "此书籍已存在且上次更新距现在不足3小时，请稍后再试"
 
                 # 如果未完结，返回提示信息并尝试更新
-                self.url_queue.put(book_id_to_url(book_id))
-                cura.execute("UPDATE novels SET status=?, chat_id=? WHERE id=?", ("等待更新中", chat_id, book_id))
-                db.commit()
                 cura.close()
+                db.write("UPDATE novels SET status=?, chat_id=? WHERE id=?", ("等待更新中", chat_id, book_id))
+                add_subscriber(book_id, chat_id, encoding)
+                self.enqueue(book_id, chat_id, True, chapters)
                 logger.debug(f"ID: {book_id} 已添加到队列 (等待更新中)")
                 return "此书籍已存在，正在尝试更新"
 
+    def add_update(self, book_id):
+        """添加后台自动更新任务，返回是否已添加"""
+        with self.add_lock:
+            curu = db.cursor()
+            curu.execute("SELECT status, chapters FROM novels WHERE id=?", (book_id,))
+            row = curu.fetchone()
+            curu.close()
+            if row is None or row[0] in ("等待中", "进行中", "等待更新中"):
+                return False
+            # 不添加订阅者，更新完成后不发送文件
+            db.write("UPDATE novels SET status=? WHERE id=?", ("等待更新中", book_id))
+            self.enqueue(book_id, None, True, row[1])
+            logger.debug(f"ID: {book_id} 已添加到队列 (自动更新)")
+            return True
+
     def stop(self):
         logger.info("爬虫工作暂停")
         # 设置运行状态为False以停止工作线程
         self.is_running = False
-
-
-if __name__ == '__main__':
-    # 创建爬虫实例并启动
-    spider = Spider()
-    spider.start()
+        # 不再接受新任务，已提交的任务执行完毕后进程池退出
+        if self.pool is not None:
+            self.pool.close()
 
 
 def api(data, chat_id):
@@ -524,9 +833,8 @@ def api(data, chat_id):
     if data['action'] == 'add':
         logger.debug(f"用户请求添加ID: {data['id']} 到队列")
         book_id = data['id']
-        message = spider.add_url(book_id, chat_id)
-        url = book_id_to_url(book_id)
-        position = list(spider.url_queue.queue).index(url) + 1 if url in list(spider.url_queue.queue) else None
+        message = spider.add_url(book_id, chat_id, data.get('encoding'))
+        position = spider.job_queue.position(book_id)
         curq = db.cursor()
         curq.execute("SELECT status, last_update FROM novels WHERE id=?", (book_id,))
         row = curq.fetchone()
@@ -543,8 +851,7 @@ def api(data, chat_id):
     elif data['action'] == 'query':
         logger.debug(f"用户请求查询ID: {data['id']} 的状态")
         book_id = data['id']
-        url = book_id_to_url(book_id)
-        position = list(spider.url_queue.queue).index(url) + 1 if url in list(spider.url_queue.queue) else None
+        position = spider.job_queue.position(book_id)
         curw = db.cursor()
         curw.execute("SELECT status, last_update FROM novels WHERE id=?", (book_id,))
         row = curw.fetchone()
@@ -558,6 +865,25 @@ def api(data, chat_id):
         return {'exists': status is not None, 'position': position, 'status': status, 'last_update': last_update}
 
 
+def main():
+    global spider
+    load_config()
+    setup()
+    # 创建爬虫实例并启动
+    spider = Spider()
+    spider.start()
+    # 启动后台自动更新
+    if config.get("auto_update", {}).get("enabled", False):
+        AutoUpdater(db, config, spider).start()
+    # 启动指标服务
+    if config.get("metrics", {}).get("enabled", False):
+        metrics.start_server(config["metrics"].get("host", "127.0.0.1"), config["metrics"].get("port", 9108))
+    if use_webhook():
+        WebhookServer(bot, config["webhook"], handler_threads()).serve_forever()
+    else:
+        bot.infinity_polling()
+
+
 if __name__ == '__main__':
-    multiprocessing.freeze_support()
-    bot.infinity_polling()
+    # 直接运行 bot.py 时转到 main.py 启动，下载进程重新导入的入口模块不包含机器人相关的模块
+    runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), run_name="__main__")
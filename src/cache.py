@@ -0,0 +1,168 @@
+
+# 导入必要的模块
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+import public as p
+
+
+# 章节内容缓存，以章节ID为键保存清洗后的章节文本，多个下载进程可共用同一个数据库文件
+class ChapterCache:
+    # 每写入多少个章节检查一次缓存大小
+    check_interval = 100
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute('''
+        CREATE TABLE IF NOT EXISTS chapters
+        (id TEXT PRIMARY KEY,
+        title TEXT,
+        text TEXT,
+        size INTEGER,
+        last_access REAL);
+        ''')
+        # 统计大小和按访问时间清理只需读取索引，不必逐行读取章节内容（较长的内容存放在溢出页中）
+        self.db.execute("DROP INDEX IF EXISTS idx_chapters_last_access")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_chapters_last_access_size ON chapters (last_access, size)")
+        self.db.commit()
+        self.evict()
+
+    def get(self, chapter_id: str):
+        """获取缓存的章节，返回与 get_api 相同的 (标题, 内容, 章节ID)，未命中时返回 None"""
+        with self.lock:
+            row = self.db.execute("SELECT title, text FROM chapters WHERE id=?", (chapter_id,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE chapters SET last_access=? WHERE id=?", (time.time(), chapter_id))
+            self.db.commit()
+        return row[0], row[1], chapter_id
+
+    def put(self, chapter_id: str, title: str, text: str):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO chapters (id, title, text, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                            (chapter_id, title, text, len(title.encode()) + len(text.encode()), time.time()))
+            self.db.commit()
+            self._puts += 1
+            if self._puts % self.check_interval != 0:
+                return
+        self.evict()
+
+    def evict(self):
+        """缓存超过大小限制时，按最近访问时间删除旧章节，直到降到限制的90%以下"""
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM chapters").fetchone()[0]
+            if total <= self.max_size:
+                return
+            target = self.max_size * 0.9
+            rowids = []
+            for rowid, size in self.db.execute("SELECT rowid, size FROM chapters ORDER BY last_access"):
+                if total <= target:
+                    break
+                rowids.append((rowid,))
+                total -= size
+            self.db.executemany("DELETE FROM chapters WHERE rowid=?", rowids)
+            self.db.commit()
+        logger.info(f"章节缓存超过大小限制，已清理{len(rowids)}个章节")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+# 目录页缓存，保存解析后的目录信息和条件请求所需的 ETag/Last-Modified
+class CatalogCache:
+    # 超过此时间未刷新的目录会在启动时清理，单位为s
+    max_age = 30 * 24 * 3600
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute('''
+        CREATE TABLE IF NOT EXISTS catalogs
+        (url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        fetched_at REAL,
+        data TEXT);
+        ''')
+        self.db.execute("DELETE FROM catalogs WHERE fetched_at < ?", (time.time() - self.max_age,))
+        self.db.commit()
+
+    def get(self, url: str):
+        """返回 (目录信息, ETag, Last-Modified, 是否仍在有效期内)，没有缓存时返回 None"""
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified, fetched_at, data FROM catalogs WHERE url=?",
+                                  (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, fetched_at, data = row
+        return json.loads(data), etag, last_modified, time.time() - fetched_at < self.ttl
+
+    def put(self, url: str, catalog: dict, etag: str = None, last_modified: str = None):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO catalogs (url, etag, last_modified, fetched_at, data) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (url, etag, last_modified, time.time(), json.dumps(catalog, ensure_ascii=False)))
+            self.db.commit()
+
+    def touch(self, url: str):
+        """目录未变化（304）时刷新有效期"""
+        with self.lock:
+            self.db.execute("UPDATE catalogs SET fetched_at=? WHERE url=?", (time.time(), url))
+            self.db.commit()
+
+
+# 每个进程共用一个缓存实例，进程池 fork 出的子进程不能沿用父进程的数据库连接
+_cache = None
+_cache_pid = None
+_catalog_cache = None
+_catalog_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_chapter_cache(config: dict):
+    """获取当前进程的章节缓存，未启用时返回 None"""
+    global _cache, _cache_pid
+    options = config.get("cache", {})
+    if not options.get("enabled", True):
+        return None
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = ChapterCache(os.path.join(options.get("dir", "cache"), "chapters.db"),
+                                  p.parse_size(options.get("chapter_max_size", "1 GB")))
+            _cache_pid = os.getpid()
+        return _cache
+
+
+def get_catalog_cache(config: dict):
+    """获取当前进程的目录页缓存，未启用时返回 None"""
+    global _catalog_cache, _catalog_cache_pid
+    options = config.get("cache", {})
+    if not options.get("enabled", True):
+        return None
+    with _cache_lock:
+        if _catalog_cache is None or _catalog_cache_pid != os.getpid():
+            _catalog_cache = CatalogCache(os.path.join(options.get("dir", "cache"), "catalogs.db"),
+                                          options.get("catalog_ttl", 600))
+            _catalog_cache_pid = os.getpid()
+        return _catalog_cache
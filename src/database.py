@@ -0,0 +1,178 @@
+
+# 导入必要的模块
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+from loguru import logger
+
+
+# 数据库访问层：每个线程使用自己的连接读取，所有写入交给单独的写入线程批量提交
+class Database:
+    def __init__(self, path: str, batch_size: int = 100):
+        self.path = path
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.writes = queue.Queue()
+        self.init_schema()
+        threading.Thread(target=self._writer, name="db-writer", daemon=True).start()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        # WAL 模式下读取不会被写入阻塞
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA recursive_triggers = ON")  # 使 INSERT OR REPLACE 删除旧行时也触发删除触发器
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """当前线程的连接"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def cursor(self) -> sqlite3.Cursor:
+        return self.conn.cursor()
+
+    def write(self, sql: str, params=(), wait: bool = True):
+        """提交一条写入语句，wait 为 True 时等待其所在批次提交完成"""
+        future = Future()
+        self.writes.put((sql, params, future))
+        if wait:
+            return future.result()
+        return future
+
+    def _writer(self):
+        conn = self.connect()
+        while True:
+            # 取出当前积压的所有写入，在一个事务中提交
+            batch = [self.writes.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    results = [conn.execute(sql, params).rowcount for sql, params, _ in batch]
+            except sqlite3.Error:
+                # 批次中有语句出错时逐条重试，只让出错的语句失败
+                for sql, params, future in batch:
+                    try:
+                        with conn:
+                            future.set_result(conn.execute(sql, params).rowcount)
+                    except sqlite3.Error as e:
+                        logger.error(f"数据库写入失败: {e} 语句: {sql}")
+                        future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def init_schema(self):
+        conn = self.connect()
+
+        # 创建一个黑名单表
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS blacklist
+        (chat_id TEXT PRIMARY KEY,
+        unblock_time TEXT);
+        ''')
+
+        # 创建一个任务状态表
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS novels
+        (id TEXT PRIMARY KEY,
+        name TEXT,
+        status TEXT,
+        last_cid TEXT,
+        last_update TEXT,
+        finished INTEGER,
+        chat_id INTEGER,
+        chapters INTEGER,
+        last_check REAL);
+        ''')
+
+        # 兼容旧版本数据库：旧版建表语句缺少逗号，导致 chat_id 列不存在；
+        # chapters（目录章节数）和 last_check（自动更新上次检查时间）为后来新增的列
+        novels_columns = [col[1] for col in conn.execute("PRAGMA table_info(novels)").fetchall()]
+        for column, column_type in (("chat_id", "INTEGER"), ("chapters", "INTEGER"), ("last_check", "REAL")):
+            if column not in novels_columns:
+                conn.execute(f"ALTER TABLE novels ADD COLUMN {column} {column_type}")
+                logger.warning(f"数据库缺少 {column} 列，已自动添加")
+
+        # /query 和启动时恢复任务都按这两列筛选
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_novels_chat_id ON novels (chat_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_novels_status ON novels (status)")
+
+        # 创建书名全文索引，使用三元组分词以支持中文，由触发器与任务状态表保持同步
+        fts_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='novels_fts'").fetchone() is not None
+        conn.executescript('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS novels_fts USING fts5
+        (name, content='novels', content_rowid='rowid', tokenize='trigram');
+        CREATE TRIGGER IF NOT EXISTS novels_fts_insert AFTER INSERT ON novels BEGIN
+          INSERT INTO novels_fts (rowid, name) VALUES (new.rowid, new.name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS novels_fts_delete AFTER DELETE ON novels BEGIN
+          INSERT INTO novels_fts (novels_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS novels_fts_update AFTER UPDATE OF name ON novels BEGIN
+          INSERT INTO novels_fts (novels_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+          INSERT INTO novels_fts (rowid, name) VALUES (new.rowid, new.name);
+        END;
+        ''')
+        if not fts_exists:
+            # 首次创建时为已有数据建立索引
+            conn.execute("INSERT INTO novels_fts (novels_fts) VALUES ('rebuild')")
+            logger.info("已为书名建立全文索引")
+
+        # 创建一个订阅者表，记录等待同一任务结果的所有用户，任务结束后一并发送
+        subscribers_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='subscribers'").fetchone() is not None
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS subscribers
+        (book_id TEXT,
+        chat_id INTEGER,
+        encoding TEXT,
+        PRIMARY KEY (book_id, chat_id));
+        ''')
+        # 订阅者的编码格式为后来新增的列，为空时使用默认编码
+        if "encoding" not in [col[1] for col in conn.execute("PRAGMA table_info(subscribers)").fetchall()]:
+            conn.execute("ALTER TABLE subscribers ADD COLUMN encoding TEXT")
+        if not subscribers_exists:
+            # 旧版本数据库中未完成的任务只记录了一个用户，迁移到订阅者表
+            conn.execute("INSERT OR IGNORE INTO subscribers (book_id, chat_id) SELECT id, chat_id FROM novels "
+                         "WHERE status IN ('进行中', '等待中', '等待更新中') AND chat_id IS NOT NULL ORDER BY ROWID")
+
+        # 创建一个下载历史表，记录每个用户请求过的书，同一本书的所有请求者都保留，/my 和 /clear 使用
+        history_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='history'").fetchone() is not None
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS history
+        (chat_id INTEGER,
+        book_id TEXT,
+        PRIMARY KEY (chat_id, book_id));
+        ''')
+        if not history_exists:
+            # 旧版本数据库只在任务状态表中记录最后一个请求者，迁移到历史表
+            conn.execute("INSERT OR IGNORE INTO history (chat_id, book_id) SELECT chat_id, id FROM novels "
+                         "WHERE chat_id IS NOT NULL ORDER BY ROWID")
+
+        # 创建一个已上传文件表，记录每本书每种编码当前版本（最后章节ID）在 Telegram 上的文件ID
+        documents_columns = [col[1] for col in conn.execute("PRAGMA table_info(documents)").fetchall()]
+        if documents_columns and "encoding" not in documents_columns:
+            # 旧版本的表只按书籍ID记录，文件ID可以重新上传获得，直接重建
+            conn.execute("DROP TABLE documents")
+            logger.warning("已上传文件表结构已变化，已重建")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS documents
+        (id TEXT,
+        encoding TEXT,
+        version TEXT,
+        file_id TEXT,
+        PRIMARY KEY (id, encoding));
+        ''')
+
+        conn.commit()
+        conn.close()
+        logger.debug("数据库初始化完成")
@@ -1,17 +1,62 @@
 
-import os
-
 # 导入必要的模块
 import re
-from os import path
-import time
 import public as p
+from fetcher import fetch_chapters
+from cache import get_chapter_cache, get_catalog_cache
+from storage import get_book_store
+from writer import BookWriter
 from loguru import logger
 
 
-# 定义正常模式用来下载番茄小说的函数
-def download(url: str, encoding: str, config: dict, chat_id: int) -> tuple:
-    from bot import bot
+def log_cache_stats(config: dict):
+    cache = get_chapter_cache(config)
+    if cache is not None:
+        stats = cache.stats()
+        logger.info(f"章节缓存 命中: {stats['hits']} 未命中: {stats['misses']} 命中率: {stats['hit_rate']:.1%}")
+
+
+def find_start_index(chapters: list, start_id: str, manifest: list):
+    """
+    返回 start_id 之后第一个章节在目录中的索引
+    start_id 不在目录中时（如作者删除了章节），按章节清单从后往前找到仍在目录中的最近章节；
+    都找不到时返回 None
+    """
+    # 章节ID -> 目录索引，每个目录只建立一次
+    index = {chapter.id: i for i, chapter in enumerate(chapters)}
+    if start_id in index:
+        return index[start_id] + 1
+    for chapter_id in reversed(manifest):
+        if chapter_id in index:
+            logger.warning(f"章节ID: {start_id} 已不在目录中，从清单中的章节ID: {chapter_id} 之后继续")
+            return index[chapter_id] + 1
+    return None
+
+
+def refetch_missing(writer: BookWriter, chapters: list, headers, config: dict) -> int:
+    """重新获取之前失败的章节并替换占位内容，返回补全的章节数"""
+    missing = writer.missing()
+    if not missing:
+        return 0
+    index = {chapter.id: chapter for chapter in chapters}
+    # 已不在目录中的章节不再补全
+    removed = [chapter_id for chapter_id in missing if chapter_id not in index]
+    if removed:
+        writer.drop_missing(removed)
+    recovered = 0
+    for chapter, result in fetch_chapters([index[chapter_id] for chapter_id in missing if chapter_id in index],
+                                          headers, config):
+        if result is None:
+            continue
+        writer.replace_chapter(*result)
+        recovered += 1
+    if recovered:
+        logger.info(f"ID: {writer.book_id} 已补全{recovered}个之前获取失败的章节")
+    return recovered
+
+
+# 定义正常模式用来下载番茄小说的函数，只负责下载和保存，由主进程发送给用户
+def download(url: str, config: dict) -> tuple:
     title = None
     last_cid = None
     finished: int = -1  # 使用数字代表小说是否已完结，-1 代表未知，0 代表未完结，1 代表已完结
@@ -28,61 +73,62 @@ def download(url: str, encoding: str, config: dict, chat_id: int) -> tuple:
             "Chrome/118.0.0.0 "
             "Safari/537.36"
         )
-        headers, title, content, chapters, finished = p.get_fanqie(url, ua)
-
-        # 定义文件名
-        file_path = path.join(config["save_dir"],
-                              config["filename_format"].format(title=title, book_id=book_id))
-
-        os.makedirs(config["save_dir"], exist_ok=True)
+        headers, title, content, chapters, finished = p.get_fanqie(url, ua, get_catalog_cache(config))
+        chapter_count = len(chapters)
 
         last_cid = None
 
-        try:
-            # 遍历每个章节链接
-            for chapter in chapters:
-                time.sleep(config["speed_limit"] if config["speed_limit"] > 0.25 else 0.25)
+        # 边下载边写入小说存储，如上次下载中断则从已保存的章节继续
+        writer = BookWriter(get_book_store(config), book_id, config.get("storage", {}).get("segment_chapters", 20))
+        resume_cid = writer.open()
+        if resume_cid is not None:
+            start_index = find_start_index(chapters, resume_cid, writer.chapter_ids())
+            if start_index is not None:
+                logger.info(f"小说《{title}》从检查点继续下载，章节ID: {resume_cid}")
+                pending = chapters[start_index:]
+                last_cid = resume_cid
+            else:
+                # 检查点中的章节已不在目录中，重新下载
+                logger.warning(f"小说《{title}》检查点章节已不存在，重新下载")
+                writer.close()
+                resume_cid = writer.open()
+        if resume_cid is None:
+            writer.write(content)
+            pending = chapters
 
-                result = p.get_api(chapter, headers)
+        try:
+            # 并发获取每个章节，结果按目录顺序返回
+            for chapter, result in fetch_chapters(pending, headers, config):
 
                 if result is None:
+                    # 获取失败的章节先写入占位内容，之后重新获取
+                    writer.write_missing(chapter.title, chapter.id)
+                    last_cid = chapter.id
                     continue
                 else:
                     chapter_title, chapter_text, chapter_id = result
 
                 last_cid = chapter_id
 
-                # 在小说内容字符串中添加章节标题和内容
-                content += f"\n\n\n{chapter_title}\n{chapter_text}"
+                # 将章节标题和内容追加到文件中
+                writer.write_chapter(chapter_title, chapter_text, chapter_id)
 
                 logger.trace(f"ID: {book_id} 已获取 {chapter_title} 章节ID: {chapter_id}")
 
-            # 根据编码转换小说内容字符串为二进制数据
-            data = content.encode(encoding, errors='ignore')
-
-            # 保存文件
-            with open(file_path, "wb") as f:
-                f.write(data)
+            writer.close()
+            # 再尝试一次获取失败的章节（包括中断前失败的），仍然失败的留待之后的更新，需要传入完整的目录
+            refetch_missing(writer, chapters, headers, config)
 
             logger.success(f"小说《{title}》已保存到本地")
-
-            with open(file_path, "rb") as f:
-                bot.send_document(chat_id, f, caption=f"小说下载完成")
-
-            logger.success(f"小说《{title}》已发送到 Telegram")
+            log_cache_stats(config)
 
             status = "completed"
 
-            return status, title, last_cid, finished
+            return status, title, last_cid, finished, chapter_count
 
         except Exception as e:
-            # 捕获所有异常，及时保存文件
-            # 根据转换小说内容字符串为二进制数据
-            data = content.encode(encoding, errors='ignore')
-
-            # 保存文件
-            with open(file_path, "wb") as f:
-                f.write(data)
+            # 捕获所有异常，已写入的章节保留在存储中，留待下次继续
+            writer.close(done=False)
 
             logger.error(f"小说《{title}》下载失败：{e}")
 
@@ -93,24 +139,15 @@ def download(url: str, encoding: str, config: dict, chat_id: int) -> tuple:
             raise Exception(f"下载失败: {e}")
 
     except Exception:
-        bot.send_message(chat_id, f"抱歉，你提交的小说（ID：{book_id}）下载失败。\n"
-                                  f"请检查你的链接或ID是否正确，或者稍后再试。\n"
-                                  f"（部分小说由于版权原因无法下载）\n")
-        return "failed", title, last_cid, finished
+        return "failed", title, last_cid, finished, None
 
 
-def update(url: str, encoding: str, start_id: str, file_path: str, config: dict, chat_id: int) -> tuple:
-    from bot import bot
+def update(url: str, start_id: str, config: dict) -> tuple:
+    """增量更新，没有新章节（也没有补全章节）时状态为 latest"""
     chapter_id_now = start_id
     finished: int = 0
     book_id = re.search(r'page/(\d+)', url).group(1)
 
-    if os.path.exists(file_path) is False:
-        logger.error(f"小说更新失败：本地文件不存在 路径：{file_path}")
-        bot.send_message(chat_id, f"抱歉，你提交的小说（ID：{book_id}）更新失败。\n"
-                                  f"文件不存在，请向管理员反馈。")
-        return "failed", chapter_id_now, finished
-
     # noinspection PyBroadException
     try:
 
@@ -120,72 +157,77 @@ def update(url: str, encoding: str, start_id: str, file_path: str, config: dict,
             "Chrome/118.0.0.0 "
             "Safari/537.36"
         )
-        headers, title, content, chapters, finished = p.get_fanqie(url, ua)
-
-        last_cid = None
-        # 找到起始章节的索引
-        start_index = 0
-        for i, chapter in enumerate(chapters):
-            chapter_url_tmp = chapter.find("a")["href"]
-            chapter_id_tmp = re.search(r"/reader/(\d+)", chapter_url_tmp).group(1)
-            if chapter_id_tmp == start_id:  # 更新函数，所以前进一个章节
-                start_index = i + 1
-            last_cid = chapter_id_tmp
+        headers, title, content, chapters, finished = p.get_fanqie(url, ua, get_catalog_cache(config))
+        chapter_count = len(chapters)
+
+        # 在已保存的章节之后继续写入，存储中最后保存的章节即为更新的起点
+        writer = BookWriter(get_book_store(config), book_id, config.get("storage", {}).get("segment_chapters", 20))
+        resume_cid = writer.open(append=True)
+        if resume_cid is not None:
+            logger.info(f"小说《{title}》从上次中断处继续更新，章节ID: {resume_cid}")
+        if writer.last_cid is not None:
+            start_id = chapter_id_now = writer.last_cid
+
+        last_cid = chapters[-1].id if chapters else None
+        if writer.last_cid is None:
+            # 旧版本保存的 txt 文件不在存储中，重新下载整本书
+            logger.warning(f"小说《{title}》不在存储中，重新下载全部章节")
+            writer.write(content)
+            start_index = 0
+        else:
+            # 找到起始章节的索引，更新函数，所以前进一个章节
+            start_index = find_start_index(chapters, start_id, writer.chapter_ids())
+        if start_index is None:
+            # 无法确定已写入的位置时放弃更新，避免把整本书重复追加到文件中
+            writer.close(done=False)
+            logger.error(f"小说《{title}》更新失败：目录和章节清单中都找不到上次更新的章节 {start_id}")
+            raise Exception(f"无法在目录中找到上次更新的章节: {start_id}")
+
+        # 先补全之前获取失败的章节
+        recovered = refetch_missing(writer, chapters, headers, config)
 
         # 判断是否已经最新
         if start_index >= len(chapters):
+            writer.close()
             logger.info(f"小说《{title}》已经是最新章节，无需更新")
-            with open(file_path, "rb") as file:
-                bot.send_document(chat_id, file, caption=f"小说已经是最新章节，无需更新")
-            return "completed", last_cid, finished
-
-        with open(file_path, 'ab') as f:
-            try:
-                # 从起始章节开始遍历每个章节链接
-                for chapter in chapters[start_index:]:
+            return "completed" if recovered else "latest", last_cid, finished, chapter_count
 
-                    time.sleep(config["speed_limit"] if config["speed_limit"] > 0.25 else 0.25)
-
-                    result = p.get_api(chapter, headers)
-
-                    if result is None:
-                        continue
-                    else:
-                        chapter_title, chapter_text, chapter_id_now = result
-
-                    # 在小说内容字符串中添加章节标题和内容
-                    content = f"\n\n\n{chapter_title}\n{chapter_text}"
-
-                    # 根据编码转换小说内容字符串为二进制数据
-                    data = content.encode(encoding, errors='ignore')
+        try:
+            # 从起始章节开始并发获取每个章节，结果按目录顺序返回
+            for chapter, result in fetch_chapters(chapters[start_index:], headers, config):
 
-                    # 将数据追加到文件中
-                    f.write(data)
+                if result is None:
+                    writer.write_missing(chapter.title, chapter.id)
+                    chapter_id_now = chapter.id
+                    continue
+                else:
+                    chapter_title, chapter_text, chapter_id_now = result
 
-                    logger.debug(f"小说: {title} 已增加 {chapter_title} 章节ID: {chapter_id_now}")
+                # 将章节标题和内容追加到文件中
+                writer.write_chapter(chapter_title, chapter_text, chapter_id_now)
 
-                logger.success(f"小说《{title}》已保存到本地，路径：{file_path}")
+                logger.debug(f"小说: {title} 已增加 {chapter_title} 章节ID: {chapter_id_now}")
 
-                with open(file_path, "rb") as file:
-                    bot.send_document(chat_id, file, caption="小说更新完成")
+            writer.close()
+            refetch_missing(writer, chapters, headers, config)
 
-                logger.success(f"小说《{title}》已发送到 Telegram")
+            logger.success(f"小说《{title}》已保存到本地")
+            log_cache_stats(config)
 
-                status = "completed"
+            status = "completed"
 
-                return status, chapter_id_now, finished
+            return status, chapter_id_now, finished, chapter_count
 
-            except Exception as e:
+        except Exception as e:
+            writer.close(done=False)
 
-                logger.error(f"小说《{title}》更新失败：{e}")
+            logger.error(f"小说《{title}》更新失败：{e}")
 
-                logger.exception(e)
+            logger.exception(e)
 
-                logger.warning(f"小说《{title}》已保存到本地（中断保存）")
+            logger.warning(f"小说《{title}》已保存到本地（中断保存）")
 
-                raise Exception(f"更新失败: {e}")
+            raise Exception(f"更新失败: {e}")
 
     except Exception:
-        bot.send_message(chat_id, f"抱歉，你提交的小说（ID：{book_id}）更新失败。\n"
-                                  f"请尝试稍后再试。")
-        return "failed", chapter_id_now, finished
+        return "failed", chapter_id_now, finished, None
@@ -0,0 +1,176 @@
+
+# 导入必要的模块
+import asyncio
+import multiprocessing
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+import metrics
+import public as p
+from cache import get_chapter_cache
+
+
+# 自适应限速器：成功时加性增加请求速度，被限流（429、503、超时、连接失败）时乘性降低（AIMD）
+# 请求失败（连接失败、超时、429、5xx）计入连续失败次数，达到阈值时熔断，暂停所有请求一段时间后以最低速度恢复
+# 接口正常响应但没有章节内容时不算失败，只把该章节记为缺失
+# 状态保存在共享内存中，所有下载进程共用一个限速器，跟随上游实际能承受的速度
+class AdaptivePacer:
+    # 共享状态中各项的位置：当前速度（次/s）、下一个请求的时间、上次降速的时间、熔断结束时间、连续失败次数、最高速度
+    RATE, NEXT, LAST_DECREASE, OPEN_UNTIL, ERRORS, MAX_RATE = range(6)
+
+    def __init__(self, state, options: dict):
+        self.state = state
+        # 最高速度由主进程计算，下载进程不必与主进程有相同的模块设置
+        self.max_rate = state[self.MAX_RATE]
+        self.min_rate = min(options.get("min_rate", 0.5), self.max_rate)
+        self.increase = options.get("increase", 0.1)  # 每秒增加的速度，为最高速度的比例
+        self.decrease = options.get("decrease", 0.7)  # 被限流时速度乘以的系数
+        self.threshold = options.get("breaker_threshold", 10)
+        self.cooldown = options.get("breaker_cooldown", 30)
+        self.retries = options.get("retries", 2)
+        self.backoff_base = options.get("backoff_base", 0.5)
+        self.backoff_max = options.get("backoff_max", 30)
+
+    @property
+    def rate(self) -> float:
+        return self.state[self.RATE]
+
+    def reserve(self) -> float:
+        """预定一个请求时间，返回需要等待的秒数"""
+        with self.state.get_lock():
+            now = time.time()
+            start = max(now, self.state[self.NEXT], self.state[self.OPEN_UNTIL])
+            self.state[self.NEXT] = start + 1 / self.state[self.RATE]
+            return start - now
+
+    def wait(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def success(self):
+        with self.state.get_lock():
+            self.state[self.ERRORS] = 0
+            rate = self.state[self.RATE]
+            # 每秒约有 rate 个请求成功，合计每秒增加 increase * max_rate
+            self.state[self.RATE] = min(self.max_rate, rate + self.increase * self.max_rate / rate)
+
+    def failure(self, throttled: bool = False):
+        """throttled 为 True 表示被限流，需要降速；其他请求失败（如 500）只计入连续失败次数"""
+        with self.state.get_lock():
+            now = time.time()
+            # 同时发出的请求会一起被限流，每秒最多降速一次
+            if throttled and now - self.state[self.LAST_DECREASE] >= 1:
+                self.state[self.RATE] = max(self.min_rate, self.state[self.RATE] * self.decrease)
+                self.state[self.LAST_DECREASE] = now
+            self.state[self.ERRORS] += 1
+            if self.state[self.ERRORS] < self.threshold:
+                return
+            self.state[self.ERRORS] = 0
+            self.state[self.OPEN_UNTIL] = now + self.cooldown
+            self.state[self.RATE] = self.min_rate
+        metrics.CIRCUIT_OPENS.inc()
+        logger.warning(f"章节接口连续失败{self.threshold}次，暂停请求{self.cooldown}秒")
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次重试前等待的秒数，指数增长并加入随机抖动"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+# speed_limit 的下限，单位为s/it
+MIN_SPEED_LIMIT = 0.25
+
+
+def max_rate(config: dict) -> float:
+    """所有下载进程合计的最高请求速度：每个工作线程按 speed_limit 限速"""
+    # speed_limit 的单位为s/it，最低为 MIN_SPEED_LIMIT
+    speed_limit = max(config["speed_limit"], MIN_SPEED_LIMIT)
+    return max(int(config.get("workers", 1)), 1) / speed_limit
+
+
+def create_pacer_state(config: dict, context=multiprocessing):
+    """在主进程中创建限速器的共享状态，通过进程池初始化函数传给下载进程，context 为进程池使用的启动方式"""
+    rate = max_rate(config)
+    return context.Array("d", [rate, 0, 0, 0, 0, rate])
+
+
+# 每个进程共用一个限速器
+_pacer = None
+_pacer_state = None
+_pacer_lock = threading.Lock()
+
+
+def set_pacer_state(state):
+    global _pacer_state, _pacer
+    with _pacer_lock:
+        _pacer_state = state
+        _pacer = None
+
+
+def get_pacer(config: dict) -> AdaptivePacer:
+    global _pacer, _pacer_state
+    with _pacer_lock:
+        if _pacer is None:
+            if _pacer_state is None:
+                # 没有共享状态时（单独运行下载函数）只在本进程内限速
+                _pacer_state = create_pacer_state(config)
+            _pacer = AdaptivePacer(_pacer_state, config.get("pacer", {}))
+        return _pacer
+
+
+async def _fetch(chapter, headers, pacer: AdaptivePacer, cache):
+    # 优先从章节缓存中读取，命中时不占用请求配额
+    if cache is not None:
+        result = cache.get(chapter.id)
+        metrics.CHAPTER_CACHE.inc(result="miss" if result is None else "hit")
+        if result is not None:
+            return result
+    # get_api 为阻塞请求，限速等待和重试也在其中，放到线程中执行
+    result = await asyncio.get_running_loop().run_in_executor(None, p.get_api, chapter, headers, pacer)
+    if cache is not None and result is not None:
+        chapter_title, chapter_text, chapter_id = result
+        cache.put(chapter_id, chapter_title, chapter_text)
+    return result
+
+
+def fetch_chapters(chapters, headers, config: dict):
+    """
+    并发获取章节内容，同时保持最多 concurrency 个请求，按目录顺序逐个返回 (章节, get_api 的结果)
+    重试后仍获取失败的章节结果为 None
+    """
+    concurrency = max(int(config.get("concurrency", 4)), 1)
+    pacer = get_pacer(config)
+    cache = get_chapter_cache(config)
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    loop.set_default_executor(executor)
+    pending = deque()
+    chapters = iter(chapters)
+    try:
+        # 先填满窗口
+        for chapter in chapters:
+            pending.append((chapter, loop.create_task(_fetch(chapter, headers, pacer, cache))))
+            if len(pending) >= concurrency:
+                break
+        while pending:
+            # 按顺序等待最早的章节，完成后补充一个新请求
+            chapter, task = pending.popleft()
+            result = loop.run_until_complete(task)
+            for next_chapter in chapters:
+                pending.append((next_chapter, loop.create_task(_fetch(next_chapter, headers, pacer, cache))))
+                break
+            yield chapter, result
+    finally:
+        # 中途退出时取消尚未完成的请求
+        tasks = [task for _, task in pending]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        executor.shutdown(wait=False, cancel_futures=True)
+        loop.close()
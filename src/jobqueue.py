@@ -0,0 +1,120 @@
+
+# 导入必要的模块
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+# 线程安全的任务队列，按书籍ID去重
+# 任务分为快速通道（增量更新、章节较少的书）和普通通道，快速通道优先；
+# 同一通道内按用户轮流取任务，避免一个用户一次添加大量书籍时占满队列
+class JobQueue:
+    FAST = 0
+    NORMAL = 1
+
+    def __init__(self, fair_share: bool = True, fast_lane: bool = True, fast_burst: int = 5):
+        self.fair_share = fair_share
+        self.fast_lane = fast_lane
+        # 普通通道有任务时，快速通道最多连续取出的任务数，防止普通任务饿死
+        self.fast_burst = fast_burst
+        self._burst = 0
+        # 每个通道中：用户 -> 该用户的任务队列，字典顺序即轮转顺序
+        self.lanes = (OrderedDict(), OrderedDict())
+        self.sizes = [0, 0]
+        # 书籍ID -> (通道, 用户, 用户内入队序号)
+        self.index = {}
+        # (通道, 用户) -> [下一个入队序号, 已出队数量]
+        self.counters = {}
+        self.cond = threading.Condition()
+
+    def put(self, book_id: str, chat_id=None, fast: bool = False) -> bool:
+        """添加任务，任务已在队列中时返回 False"""
+        with self.cond:
+            if book_id in self.index:
+                return False
+            lane = self.FAST if fast and self.fast_lane else self.NORMAL
+            user = chat_id if self.fair_share else None
+            counter = self.counters.setdefault((lane, user), [0, 0])
+            self.index[book_id] = (lane, user, counter[0])
+            counter[0] += 1
+            self.lanes[lane].setdefault(user, deque()).append(book_id)
+            self.sizes[lane] += 1
+            self.cond.notify()
+            return True
+
+    def _pick_lane(self) -> int:
+        if self.sizes[self.FAST] == 0:
+            return self.NORMAL
+        if self.sizes[self.NORMAL] > 0 and self._burst >= self.fast_burst:
+            return self.NORMAL
+        return self.FAST
+
+    def get(self, timeout: float = None) -> str:
+        """按调度策略取出下一个任务，超时仍没有任务时抛出 queue.Empty"""
+        with self.cond:
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            while not len(self.index):
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self.cond.wait(remaining)
+            lane = self._pick_lane()
+            self._burst = self._burst + 1 if lane == self.FAST else 0
+            users = self.lanes[lane]
+            # 取轮转顺序中第一个用户的最早任务，然后把该用户移到末尾
+            user, jobs = next(iter(users.items()))
+            book_id = jobs.popleft()
+            if jobs:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            self.sizes[lane] -= 1
+            self.counters[(lane, user)][1] += 1
+            if self.counters[(lane, user)][0] == self.counters[(lane, user)][1]:
+                del self.counters[(lane, user)]
+            del self.index[book_id]
+            return book_id
+
+    def position(self, book_id: str):
+        """
+        返回任务在队列中的预计位置（从1开始），不在队列中时返回 None
+        按当前队列内容模拟轮转顺序和快速通道的连续取出次数计算，之后入队的任务不计入，
+        耗时只与用户数有关，与队列长度无关
+        """
+        with self.cond:
+            if book_id not in self.index:
+                return None
+            lane, user, seq = self.index[book_id]
+            # 该任务前面还有 k 个同一用户的任务
+            k = seq - self.counters[(lane, user)][1]
+            rank = k + 1
+            ahead = True
+            for other, jobs in self.lanes[lane].items():
+                if other == user:
+                    ahead = False
+                    continue
+                # 轮转顺序在前的用户可以多取一轮
+                rank += min(len(jobs), k + 1 if ahead else k)
+            return rank + self._other_lane_ahead(lane, rank)
+
+    def _other_lane_ahead(self, lane: int, rank: int) -> int:
+        """在本通道第 rank 个任务之前，另一通道会被取出的任务数"""
+        fast, normal = self.sizes
+        # 两个通道都有任务时，快速通道先取满本轮剩余的次数，之后每取一个普通任务再连续取 fast_burst 个
+        first = max(self.fast_burst - self._burst, 0)
+        if lane == self.FAST:
+            if rank <= first:
+                return 0
+            if self.fast_burst <= 0:
+                return normal
+            return min(normal, -(-(rank - first) // self.fast_burst))
+        return min(fast, first + (rank - 1) * max(self.fast_burst, 0))
+
+    def __contains__(self, book_id: str) -> bool:
+        with self.cond:
+            return book_id in self.index
+
+    def __len__(self) -> int:
+        with self.cond:
+            return len(self.index)
@@ -0,0 +1,8 @@
+# 程序入口，只保留启动代码
+# forkserver 启动的下载进程会重新导入入口模块，机器人、数据库等模块只在主进程中导入，不随下载进程加载
+import multiprocessing
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    import bot
+    bot.main()
@@ -0,0 +1,256 @@
+
+# 导入必要的模块
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+# 默认的耗时分桶，单位为s
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+# 简单的指标实现，输出 Prometheus 文本格式
+# 下载进程中记录的计数器和直方图在任务结束时随结果返回，由主进程合并
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        """返回 [(名称后缀, 标签, 值)]"""
+        with self.lock:
+            return [("", dict(key), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # [各分桶计数..., 总和, 数量]，分桶计数不累加，输出时再累加
+            data = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def merged(self):
+        """合并所有标签的数据"""
+        with self.lock:
+            total = [0] * (len(self.buckets) + 2)
+            for data in self.values.values():
+                total = [a + b for a, b in zip(total, data)]
+        return total
+
+    def quantile(self, q: float):
+        """按分桶估算分位数（取所在分桶的上界），没有数据时返回 None"""
+        data = self.merged()
+        if data[-1] == 0:
+            return None
+        target = q * data[-1]
+        count = 0
+        for i, bound in enumerate(self.buckets):
+            count += data[i]
+            if count >= target:
+                return bound
+        return float("inf")
+
+    def count(self, **labels) -> int:
+        with self.lock:
+            data = self.values.get(self.key(labels))
+        return data[-1] if data else 0
+
+    def mean(self):
+        data = self.merged()
+        return data[-2] / data[-1] if data[-1] else None
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(dict(key), list(data)) for key, data in self.values.items()]
+        for labels, data in items:
+            count = 0
+            for i, bound in enumerate(self.buckets):
+                count += data[i]
+                samples.append(("_bucket", dict(labels, le=format_value(bound)), count))
+            samples.append(("_bucket", dict(labels, le="+Inf"), data[-1]))
+            samples.append(("_sum", labels, data[-2]))
+            samples.append(("_count", labels, data[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, func):
+        """输出前调用的函数，用于更新队列长度等即时数据"""
+        self.collectors.append(func)
+
+    def collect(self) -> dict:
+        """取出计数器和直方图的数据并清零，供下载进程随任务结果返回"""
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            if metric.kind == "gauge":
+                continue
+            with metric.lock:
+                if metric.values:
+                    snapshot[name] = metric.values
+                    metric.values = {}
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        """合并下载进程返回的数据"""
+        for name, values in snapshot.items():
+            metric = self.metrics.get(name)
+            if metric is None:
+                continue
+            with metric.lock:
+                for key, value in values.items():
+                    if metric.kind == "histogram":
+                        data = metric.values.setdefault(key, [0] * len(value))
+                        metric.values[key] = [a + b for a, b in zip(data, value)]
+                    else:
+                        metric.values[key] = metric.values.get(key, 0) + value
+
+    def render(self) -> str:
+        for func in self.collectors:
+            # noinspection PyBroadException
+            try:
+                func()
+            except Exception as e:
+                logger.warning(f"更新指标失败: {e}")
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f'{k}="{escape(str(v))}"' for k, v in labels.items())
+                    lines.append(f"{name}{suffix}{{{label_text}}} {format_value(value)}")
+                else:
+                    lines.append(f"{name}{suffix} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+# 下载各阶段
+CATALOG_SECONDS = REGISTRY.register(Histogram("fanqie_catalog_fetch_seconds", "目录页获取耗时"))
+CATALOG_REQUESTS = REGISTRY.register(Counter("fanqie_catalog_requests_total", "目录页获取次数，按缓存结果区分"))
+CHAPTER_SECONDS = REGISTRY.register(Histogram("fanqie_chapter_request_seconds", "章节接口单次请求耗时"))
+CHAPTER_RETRIES = REGISTRY.register(Counter("fanqie_chapter_retries_total", "章节接口重试次数"))
+CHAPTER_FAILURES = REGISTRY.register(Counter("fanqie_chapter_failures_total", "重试后仍获取失败而跳过的章节数"))
+CIRCUIT_OPENS = REGISTRY.register(Counter("fanqie_circuit_opens_total", "章节接口熔断次数"))
+PACER_RATE = REGISTRY.register(Gauge("fanqie_pacer_rate", "当前章节接口请求速度，单位为次/s"))
+CHAPTERS_MISSING = REGISTRY.register(Counter("fanqie_chapters_missing_total", "获取失败而留待重新获取的章节数"))
+CHAPTERS_RECOVERED = REGISTRY.register(Counter("fanqie_chapters_recovered_total", "重新获取成功的章节数"))
+CHAPTER_CACHE = REGISTRY.register(Counter("fanqie_chapter_cache_total", "章节缓存查询次数，按命中结果区分"))
+CLEAN_SECONDS = REGISTRY.register(Histogram("fanqie_clean_seconds", "章节清洗耗时",
+                                            (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)))
+STORE_SECONDS = REGISTRY.register(Histogram("fanqie_store_write_seconds", "章节段压缩写入耗时"))
+EXPORT_SECONDS = REGISTRY.register(Histogram("fanqie_export_seconds", "导出 txt 文件耗时"))
+PACKAGE_SECONDS = REGISTRY.register(Histogram("fanqie_package_seconds", "超过上传限制的文件压缩和分卷耗时"))
+UPLOAD_SECONDS = REGISTRY.register(Histogram("fanqie_upload_seconds", "上传文件到 Telegram 的耗时"))
+# 任务
+JOB_SECONDS = REGISTRY.register(Histogram("fanqie_job_seconds", "任务总耗时，按模式和结果区分"))
+CHAPTERS_WRITTEN = REGISTRY.register(Counter("fanqie_chapters_written_total", "写入存储的章节数"))
+# 发送
+OUTBOX_PENDING = REGISTRY.register(Gauge("fanqie_outbox_pending", "等待发送到 Telegram 的消息数"))
+OUTBOX_THROTTLED = REGISTRY.register(Counter("fanqie_outbox_throttled_total", "Telegram 返回 429 而重试的次数"))
+OUTBOX_COALESCED = REGISTRY.register(Counter("fanqie_outbox_coalesced_total", "被合并的重复状态消息数"))
+# 队列
+QUEUE_DEPTH = REGISTRY.register(Gauge("fanqie_queue_depth", "队列中等待的任务数，按通道区分"))
+JOBS_RUNNING = REGISTRY.register(Gauge("fanqie_jobs_running", "正在进行的任务数"))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(host: str, port: int):
+    """在后台线程中提供 /metrics"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"指标服务已启动: http://{host}:{server.server_port}/metrics")
+    return server
@@ -0,0 +1,207 @@
+
+# 导入必要的模块
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# noinspection PyPackageRequirements
+import telebot
+from loguru import logger
+
+import metrics
+
+
+# 令牌桶，rate 为每秒补充的令牌数，burst 为最多积攒的令牌数
+class Bucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """距离有可用令牌的秒数"""
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+# 发送通道
+MESSAGE = "message"
+DOCUMENT = "document"
+
+
+class Message:
+    def __init__(self, chat_id, func, args, kwargs, coalesce, lane):
+        self.chat_id = chat_id
+        self.lane = lane
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.attempts = 0
+        self.future = Future()
+
+
+# 发往 Telegram 的消息统一排队发送，按全局和每个会话的发送频率限制取出
+# 同一会话的消息按顺序逐个发送，不同会话之间轮流发送；收到 429 时按 retry_after 暂停该会话后重试
+# 带有相同 coalesce 键且尚未发出的消息只保留最新的一条，避免重复的状态消息挤占发送额度
+# 文件和文本消息分为两条通道，由各自的线程池发送，上传大文件时不会阻塞命令的回复
+class Outbox:
+    def __init__(self, bot: telebot.TeleBot, options: dict):
+        self.bot = bot
+        self.global_bucket = Bucket(options.get("global_rate", 30), options.get("global_burst", 30))
+        self.chat_rate = options.get("chat_rate", 1)
+        self.chat_burst = options.get("chat_burst", 3)
+        self.group_rate = options.get("group_rate", 20 / 60)  # 群组每分钟最多20条
+        self.max_retries = options.get("max_retries", 5)
+        self.queues = OrderedDict()  # ChatID -> 待发送的消息
+        self.buckets = {}
+        self.paused = {}  # ChatID -> 暂停到的时间
+        self.global_paused = 0
+        self.sending = set()  # 正在发送消息的 (会话, 通道)
+        self.cond = threading.Condition()
+        self.senders = ThreadPoolExecutor(max_workers=max(int(options.get("senders", 4)), 1),
+                                          thread_name_prefix="outbox")
+        self.uploaders = ThreadPoolExecutor(max_workers=max(int(options.get("document_senders", 2)), 1),
+                                            thread_name_prefix="outbox-document")
+        metrics.REGISTRY.add_collector(self.update_metrics)
+        threading.Thread(target=self.run, name="outbox", daemon=True).start()
+
+    def update_metrics(self):
+        with self.cond:
+            metrics.OUTBOX_PENDING.set(sum(len(queue) for queue in self.queues.values()))
+
+    def submit(self, chat_id, func, *args, coalesce: str = None, lane: str = MESSAGE, **kwargs) -> Future:
+        """添加一条待发送的消息，返回发送结果的 Future"""
+        message = Message(chat_id, func, args, kwargs, coalesce, lane)
+        with self.cond:
+            queue = self.queues.setdefault(chat_id, deque())
+            if coalesce is not None:
+                for i, queued in enumerate(queue):
+                    if queued.coalesce == coalesce and queued.attempts == 0:
+                        # 替换尚未发出的旧消息，旧消息的 Future 随新消息一起完成
+                        queue[i] = message
+                        message.future.add_done_callback(lambda future, old=queued.future: copy_result(future, old))
+                        metrics.OUTBOX_COALESCED.inc()
+                        return message.future
+            queue.append(message)
+            self.cond.notify()
+        return message.future
+
+    def send_message(self, chat_id, text, coalesce: str = None, **kwargs) -> Future:
+        return self.submit(chat_id, self.bot.send_message, chat_id, text, coalesce=coalesce, **kwargs)
+
+    def send_document(self, chat_id, document, **kwargs) -> Future:
+        return self.submit(chat_id, self.bot.send_document, chat_id, document, lane=DOCUMENT, **kwargs)
+
+    def edit_message_reply_markup(self, chat_id, message_id, **kwargs) -> Future:
+        return self.submit(chat_id, self.bot.edit_message_reply_markup, chat_id, message_id,
+                           coalesce=f"edit:{message_id}", **kwargs)
+
+    def chat_bucket(self, chat_id) -> Bucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            # 群组和频道的 ChatID 为负数，发送频率限制更严格
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = Bucket(self.group_rate, 1)
+            else:
+                bucket = Bucket(self.chat_rate, self.chat_burst)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def next_message(self, now: float):
+        """取出下一条可以发送的消息，没有时返回 (None, 需要等待的秒数)"""
+        wait = self.global_bucket.wait_time(now)
+        wait = max(wait, self.global_paused - now)
+        if wait > 0:
+            return None, wait
+        wait = None
+        for chat_id in list(self.queues):
+            queue = self.queues[chat_id]
+            if not queue:
+                # 空闲且令牌已满的会话不再保留状态
+                del self.queues[chat_id]
+                bucket = self.buckets.get(chat_id)
+                if bucket is not None and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.burst:
+                    del self.buckets[chat_id]
+                if self.paused.get(chat_id, now) <= now:
+                    self.paused.pop(chat_id, None)
+                continue
+            # 同一会话同一通道的消息逐个发送，正在上传文件时仍可以发送文本消息
+            lane = next((message.lane for message in queue if (chat_id, message.lane) not in self.sending), None)
+            if lane is None:
+                continue
+            bucket = self.chat_bucket(chat_id)
+            chat_wait = max(bucket.wait_time(now), self.paused.get(chat_id, 0) - now)
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            bucket.take()
+            self.global_bucket.take()
+            # 发送后移到末尾，各会话轮流发送
+            self.queues.move_to_end(chat_id)
+            self.sending.add((chat_id, lane))
+            # 取出该通道最早的一条，各通道内保持原有顺序
+            for i, message in enumerate(queue):
+                if message.lane == lane:
+                    del queue[i]
+                    return message, 0
+        return None, wait
+
+    def run(self):
+        while True:
+            with self.cond:
+                message, wait = self.next_message(time.monotonic())
+                if message is None:
+                    self.cond.wait(wait)
+                    continue
+            executor = self.uploaders if message.lane == DOCUMENT else self.senders
+            executor.submit(self.send, message)
+
+    def send(self, message: Message):
+        message.attempts += 1
+        retry_after = None
+        # 重试上传文件时从头读取
+        for arg in message.args + tuple(message.kwargs.values()):
+            if hasattr(arg, "seek"):
+                arg.seek(0)
+        # noinspection PyBroadException
+        try:
+            result = message.func(*message.args, **message.kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429 and message.attempts <= self.max_retries:
+                retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+            else:
+                message.future.set_exception(e)
+        except Exception as e:
+            message.future.set_exception(e)
+        else:
+            message.future.set_result(result)
+        with self.cond:
+            self.sending.discard((message.chat_id, message.lane))
+            if retry_after is not None:
+                # 超过频率限制，暂停该会话，放回队首等待重试
+                metrics.OUTBOX_THROTTLED.inc()
+                logger.warning(f"ChatID: {message.chat_id} 发送过快，{retry_after}秒后重试")
+                now = time.monotonic()
+                self.paused[message.chat_id] = now + retry_after
+                # 有其他会话同时被限流时，说明超过了全局限制，全部暂停
+                if any(until > now for chat_id, until in self.paused.items() if chat_id != message.chat_id):
+                    self.global_paused = now + retry_after
+                self.queues.setdefault(message.chat_id, deque()).appendleft(message)
+            self.cond.notify()
+
+
+def copy_result(source: Future, target: Future):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
@@ -20,9 +20,65 @@ https://www.gnu.org/licenses/gpl-3.0.html
 无论您对程序进行了任何操作，请始终保留此信息。
 """
 
+import os
 import re
-from bs4 import BeautifulSoup
+import threading
+from html.parser import HTMLParser
+from typing import NamedTuple
+import time
 import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# 判断是否支持 brotli 压缩
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# 网络请求设置，可通过 configure_http 修改
+http_options = {
+    "pool_size": 10,  # 每个主机保持的连接数
+    "timeout": 5,  # 章节接口超时时间，单位为s
+    "catalog_timeout": 20,  # 目录页超时时间，单位为s
+    "page_url": "https://fanqienovel.com/page/{book_id}",  # 目录页地址
+    "api_url": "https://novel.snssdk.com/api/novel/book/reader/full/v1/",  # 章节接口地址
+}
+
+# 每个进程共用一个会话，复用 TCP/TLS 连接
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def configure_http(options: dict):
+    """更新网络请求设置，下次获取会话时生效"""
+    global _session
+    http_options.update(options)
+    with _session_lock:
+        _session = None
+
+
+def get_session() -> requests.Session:
+    """获取当前进程的会话，子进程会重新创建，避免共用父进程的连接"""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=http_options["pool_size"])
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Accept-Encoding": ACCEPT_ENCODING, "Connection": "keep-alive"})
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+def page_url(book_id: str) -> str:
+    return http_options["page_url"].format(book_id=book_id)
 
 
 # 替换非法字符
@@ -48,6 +104,55 @@ def rename(name):
     return sanitized_path
 
 
+# 预编译的章节清洗规则
+# 一次性去除所有 html 标签和出版物标签，各分支顺序与 fix_publisher 中的替换顺序一致，
+# 提取出公共的 "<" 前缀后正则引擎可以直接跳到下一个 "<" 处匹配
+TAG_PATTERN = re.compile(r'<(?:/?\w+>'
+                         r'|p class=".*?">'
+                         r'|!--\?xml.*?>'
+                         r'|link .*?/>'
+                         r'|meta .*?/>'
+                         r'|h1 .*?>'
+                         r'|br/>'
+                         r'|!DOCTYPE html .*?>'
+                         r'|span .*?>'
+                         r'|html .*?>)')
+
+
+def remove_tags(text):
+    """
+    去除 html 标签和出版物标签，结果与依次执行原有的各个正则替换（先 </?\w+>，再 fix_publisher）相同
+    各分支的前缀互不相同，当每个 "<" 都恰好是一个匹配的开头、匹配中没有其他 "<" 时，
+    去掉一个标签不会产生新的匹配，单次替换与依次替换结果相同；
+    否则（标签嵌套、残缺的标签等）去掉一个标签可能让后面的规则产生新的匹配，按原有顺序逐个替换
+    """
+    result, count = TAG_PATTERN.subn("", text)
+    if count == text.count("<"):
+        return result
+    return fix_publisher(re.sub(r"</?\w+>", "", text))
+
+
+# 清洗 api 返回的章节内容，结果与依次执行原有的各个正则替换相同
+def clean_chapter(chapter_content):
+    # 提取文章标签中的文本，等同于 re.search(r"<article>([\s\S]*?)</article>")，但不需要逐字符尝试匹配
+    start = chapter_content.index("<article>") + len("<article>")
+    chapter_text = chapter_content[start:chapter_content.index("</article>", start)]
+
+    # 将 <p> 标签替换为换行符，再去除其余标签
+    return remove_tags(chapter_text.replace("<p>", "\n"))
+
+
+# 将 "20 MB" 这样的大小描述转换为字节数
+def parse_size(size) -> int:
+    if isinstance(size, (int, float)):
+        return int(size)
+    units = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?B)\s*", size.upper())
+    if match is None:
+        raise ValueError(f"无法识别的大小: {size}")
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
 def fix_publisher(text):
     # 针对性去除所有 出版物 所携带的标签
     text = re.sub(r'<p class=".*?">', '', text)
@@ -62,30 +167,134 @@ def fix_publisher(text):
     return text
 
 
-def get_fanqie(url, user_agent):
-    headers = {
-        "User-Agent": user_agent
+# 章节记录：章节ID和标题
+class Chapter(NamedTuple):
+    id: str
+    title: str
+
+
+# 流式解析目录页，只提取需要的文本和章节列表，不构建完整的文档树
+class CatalogParser(HTMLParser):
+    # 需要提取文本的元素：名称 -> (标签, class)，class 为 None 表示不限，均只取第一个
+    targets = {
+        "title": ("h1", None),
+        "info": ("div", "page-header-info"),
+        "intro": ("div", "page-abstract-content"),
+        "finished": ("span", "info-label-yellow"),
     }
 
-    # 获取网页源码
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.texts = {}
+        self.chapters = []
+        # 正在提取文本的元素：[名称, 标签, 同名标签嵌套深度, 文本片段]
+        self.active = []
+        # 当前章节项的嵌套深度和其中第一个链接的地址
+        self.chapter_depth = 0
+        self.chapter_href = None
+        self.chapter_link = None
+
+    def handle_starttag(self, tag, attrs):
+        for capture in self.active:
+            if capture[1] == tag:
+                capture[2] += 1
+        classes = None
+        for key, value in attrs:
+            if key == "class":
+                classes = (value or "").split()
+        for name, (target_tag, target_class) in self.targets.items():
+            if tag == target_tag and name not in self.texts and \
+                    (target_class is None or (classes is not None and target_class in classes)):
+                self.texts[name] = None
+                self.active.append([name, tag, 1, []])
+        if tag == "div":
+            if self.chapter_depth:
+                self.chapter_depth += 1
+            elif classes is not None and "chapter-item" in classes:
+                self.chapter_depth = 1
+                self.chapter_href = None
+        elif tag == "a" and self.chapter_depth and self.chapter_href is None:
+            self.chapter_href = dict(attrs).get("href") or ""
+            self.active.append(["chapter", tag, 1, []])
+
+    def handle_endtag(self, tag):
+        for capture in self.active[:]:
+            if capture[1] != tag:
+                continue
+            capture[2] -= 1
+            if capture[2] == 0:
+                self.active.remove(capture)
+                text = "".join(capture[3])
+                if capture[0] == "chapter":
+                    match = re.search(r"/reader/(\d+)", self.chapter_href)
+                    if match is not None:
+                        self.chapters.append(Chapter(match.group(1), text))
+                else:
+                    self.texts[capture[0]] = text
+        if tag == "div" and self.chapter_depth:
+            self.chapter_depth -= 1
+
+    def handle_data(self, data):
+        for capture in self.active:
+            capture[3].append(data)
+
+
+def parse_catalog(html):
+    """解析目录页，返回 (标题, 信息, 简介, 章节列表, 是否完结)"""
+    parser = CatalogParser()
+    parser.feed(html)
+    parser.close()
+    texts = parser.texts
+    for name in CatalogParser.targets:
+        if texts.get(name) is None:
+            raise ValueError(f"目录页解析失败，未找到: {name}")
+    # 替换非法字符
+    title = rename(texts["title"])
+    finished = 1 if texts["finished"] == "已完结" else 0
+    return title, texts["info"], texts["intro"], parser.chapters, finished
 
-    response = requests.get(url, headers=headers, timeout=20)
-    html = response.text
 
-    # 解析网页源码
-    soup = BeautifulSoup(html, "html.parser")
+def get_fanqie(url, user_agent, cache=None):
+    headers = {
+        "User-Agent": user_agent
+    }
 
-    # 获取小说标题
-    title = soup.find("h1").get_text()
-    # , class_ = "info-name"
-    # 替换非法字符
-    title = rename(title)
+    # 有效期内的目录直接使用缓存，过期后带上 ETag/Last-Modified 发送条件请求
+    cached = cache.get(url) if cache is not None else None
+    if cached is not None and cached[3]:
+        catalog = cached[0]
+        metrics.CATALOG_REQUESTS.inc(result="cached")
+    else:
+        start = time.perf_counter()
+        request_headers = dict(headers)
+        if cached is not None:
+            if cached[1]:
+                request_headers["If-None-Match"] = cached[1]
+            if cached[2]:
+                request_headers["If-Modified-Since"] = cached[2]
+
+        # 获取网页源码
+        response = get_session().get(url, headers=request_headers, timeout=http_options["catalog_timeout"])
+
+        if cached is not None and response.status_code == 304:
+            # 目录未变化
+            cache.touch(url)
+            catalog = cached[0]
+            result = "not_modified"
+        else:
+            html = response.text
 
-    # 获取小说信息
-    info = soup.find("div", class_="page-header-info").get_text()
+            # 解析网页源码，获取小说标题、信息、简介、所有章节和完结信息
+            title, info, intro, chapters, finished = parse_catalog(html)
+            catalog = {"title": title, "info": info, "intro": intro, "chapters": chapters, "finished": finished}
+            if cache is not None:
+                cache.put(url, catalog, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            result = "fetched"
+        metrics.CATALOG_REQUESTS.inc(result=result)
+        metrics.CATALOG_SECONDS.observe(time.perf_counter() - start, result=result)
 
-    # 获取小说简介
-    intro = soup.find("div", class_="page-abstract-content").get_text()
+    title, info, intro, finished = catalog["title"], catalog["info"], catalog["intro"], catalog["finished"]
+    chapters = [Chapter(*chapter) for chapter in catalog["chapters"]]
 
     # 拼接小说内容字符串
     content = f"""如果需要小说更新，请勿修改文件名
@@ -99,70 +308,69 @@ Gitee:https://gitee.com/xingyv1024/fanqie-novel-download/
 {intro}
 """
 
-    # 获取所有章节链接
-    chapters = soup.find_all("div", class_="chapter-item")
-
-    # 通过标签得到完结信息
-    finished_text = soup.find("span", class_="info-label-yellow").get_text()
-    finished = 1 if finished_text == "已完结" else 0
-
     return headers, title, content, chapters, finished
 
 
-def get_api(chapter, headers):
-    # 获取章节标题
-    chapter_title = chapter.find("a").get_text()
+def is_throttled(e: Exception) -> bool:
+    """请求失败是否说明上游在限流或过载：429、503、超时和连接失败"""
+    if isinstance(e, (requests.Timeout, requests.ConnectionError)):
+        return True
+    response = getattr(e, "response", None)
+    return response is not None and response.status_code in (429, 503)
 
-    # 获取章节网址
-    chapter_url = chapter.find("a")["href"]
 
-    # 获取章节 id
-    chapter_id = re.search(r"/reader/(\d+)", chapter_url).group(1)
+def get_api(chapter, headers, pacer=None):
+    # 获取章节标题和章节 id
+    chapter_title, chapter_id = chapter.title, chapter.id
 
     # 构造 api 网址
-    api_url = (f"https://novel.snssdk.com/api/novel/book/reader/full/v1/?device_platform=android&"
+    api_url = (f"{http_options['api_url']}?device_platform=android&"
                f"parent_enterfrom=novel_channel_search.tab.&aid=2329&platform_id=1&group_id="
                f"{chapter_id}&item_id={chapter_id}")
-    # 尝试获取章节内容
+    # 尝试获取章节内容，每次请求前按限速器等待，失败后按指数退避等待再重试
     chapter_content = None
-    retry_count = 1
-    while retry_count < 4:  # 设置最大重试次数
+    attempts = pacer.retries + 1 if pacer is not None else 3
+    for attempt in range(attempts):
+        if attempt > 0:
+            logger.debug(f"第 ({attempt}/{attempts - 1}) 次重试获取章节内容")
+            metrics.CHAPTER_RETRIES.inc()
+            if pacer is not None:
+                time.sleep(pacer.backoff(attempt))
+        if pacer is not None:
+            pacer.wait()
+        start = time.perf_counter()
         try:
             # 获取 api 响应
-            api_response = requests.get(api_url, headers=headers, timeout=5)
-
-            # 解析 api 响应为 json 数据
-            api_data = api_response.json()
+            api_response = get_session().get(api_url, headers=headers, timeout=http_options["timeout"])
+            # 被限流或服务端出错
+            if api_response.status_code == 429 or api_response.status_code >= 500:
+                raise requests.HTTPError(f"HTTP {api_response.status_code}", response=api_response)
         except Exception as e:
-            if retry_count == 1:
-                print(f"发生异常: {e}")
-                print(f"{chapter_title} 获取失败，正在尝试重试...")
-            print(f"第 ({retry_count}/3) 次重试获取章节内容")
-            retry_count += 1  # 否则重试
+            # 只有请求本身失败（连接、超时、429、5xx）才计入限速器的失败次数
+            metrics.CHAPTER_SECONDS.observe(time.perf_counter() - start)
+            if pacer is not None:
+                pacer.failure(is_throttled(e))
+            if attempt == 0:
+                logger.warning(f"{chapter_title} 获取失败，正在尝试重试: {e!r}")
             continue
-
-        if "data" in api_data and "content" in api_data["data"]:
-            chapter_content = api_data["data"]["content"]
-            break  # 如果成功获取章节内容，跳出重试循环
-        else:
-            if retry_count == 1:
-                print(f"{chapter_title} 获取失败，正在尝试重试...")
-            print(f"第 ({retry_count}/3) 次重试获取章节内容")
-            retry_count += 1  # 否则重试
-
-    if retry_count == 4:
-        print(f"无法获取章节内容: {chapter_title}，跳过。")
+        metrics.CHAPTER_SECONDS.observe(time.perf_counter() - start)
+        if pacer is not None:
+            pacer.success()
+        try:
+            # 解析 api 响应为 json 数据
+            chapter_content = api_response.json()["data"]["content"]
+        except (ValueError, KeyError, TypeError) as e:
+            # 接口正常响应但没有章节内容（章节下架、未解锁等），重试也无法获取，直接作为缺失章节
+            logger.warning(f"{chapter_title} 接口没有返回章节内容: {e!r}")
+        break  # 接口已正常响应，不再重试
+
+    if chapter_content is None:
+        logger.error(f"无法获取章节内容: {chapter_title}，跳过。")
+        metrics.CHAPTER_FAILURES.inc()
         return  # 重试次数过多后，跳过当前章节
 
-    # 提取文章标签中的文本
-    chapter_text = re.search(r"<article>([\s\S]*?)</article>", chapter_content).group(1)
-
-    # 将 <p> 标签替换为换行符
-    chapter_text = re.sub(r"<p>", "\n", chapter_text)
-
-    # 去除其他 html 标签
-    chapter_text = re.sub(r"</?\w+>", "", chapter_text)
-
-    chapter_text = fix_publisher(chapter_text)
+    # 提取文章标签中的文本并去除 html 标签
+    with metrics.CLEAN_SECONDS.time():
+        chapter_text = clean_chapter(chapter_content)
 
     return chapter_title, chapter_text, chapter_id
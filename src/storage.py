@@ -0,0 +1,446 @@
+
+# 导入必要的模块
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import zipfile
+import zlib
+
+from loguru import logger
+
+import metrics
+import public as p
+
+# 支持导出的编码格式
+ENCODINGS = ("utf-8", "gbk", "gb2312")
+
+
+# 小说存储：每本书的章节按顺序分段，每段若干章节压缩后保存，与导出的编码无关
+class BookStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # writing 为 1 表示上次写入未完成，可以从已保存的章节继续
+        self.db.execute('''
+        CREATE TABLE IF NOT EXISTS books
+        (id TEXT PRIMARY KEY,
+        header BLOB,
+        last_cid TEXT,
+        chapters INTEGER,
+        writing INTEGER);
+        ''')
+        # ids 为段内章节ID，以空格分隔，不解压即可得到章节清单
+        self.db.execute('''
+        CREATE TABLE IF NOT EXISTS segments
+        (book_id TEXT,
+        seq INTEGER,
+        count INTEGER,
+        ids TEXT,
+        data BLOB,
+        PRIMARY KEY (book_id, seq));
+        ''')
+        # 获取失败、暂时以占位内容写入的章节，之后重新获取
+        self.db.execute('''
+        CREATE TABLE IF NOT EXISTS missing
+        (book_id TEXT,
+        chapter_id TEXT,
+        PRIMARY KEY (book_id, chapter_id));
+        ''')
+        # revision 为补全章节的次数，最后章节ID不变但内容变化时用于区分版本
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(books)")]
+        if "revision" not in columns:
+            self.db.execute("ALTER TABLE books ADD COLUMN revision INTEGER DEFAULT 0")
+        self.db.commit()
+
+    def book(self, book_id: str):
+        """返回 (最后章节ID, 章节数, 是否未写完)，不存在时返回 None"""
+        with self.lock:
+            return self.db.execute("SELECT last_cid, chapters, writing FROM books WHERE id=?", (book_id,)).fetchone()
+
+    def reset(self, book_id: str):
+        with self.lock:
+            self.db.execute("DELETE FROM segments WHERE book_id=?", (book_id,))
+            self.db.execute("DELETE FROM missing WHERE book_id=?", (book_id,))
+            self.db.execute("INSERT OR REPLACE INTO books (id, header, last_cid, chapters, writing, revision) "
+                            "VALUES (?, ?, NULL, 0, 1, 0)", (book_id, compress("")))
+            self.db.commit()
+
+    def set_writing(self, book_id: str, writing: bool):
+        with self.lock:
+            self.db.execute("UPDATE books SET writing=? WHERE id=?", (int(writing), book_id))
+            self.db.commit()
+
+    def put_header(self, book_id: str, header: str):
+        with self.lock:
+            self.db.execute("UPDATE books SET header=? WHERE id=?", (compress(header), book_id))
+            self.db.commit()
+
+    def header(self, book_id: str) -> str:
+        with self.lock:
+            row = self.db.execute("SELECT header FROM books WHERE id=?", (book_id,)).fetchone()
+        return decompress(row[0]) if row is not None else ""
+
+    def last_segment(self, book_id: str):
+        """返回最后一段的 (序号, 章节列表)，没有章节时返回 None"""
+        with self.lock:
+            row = self.db.execute("SELECT seq, data FROM segments WHERE book_id=? ORDER BY seq DESC LIMIT 1",
+                                  (book_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(decompress(row[1]))
+
+    def put_segment(self, book_id: str, seq: int, chapters: list):
+        """保存一段章节（已存在时替换），并更新书的最后章节ID和章节数"""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO segments (book_id, seq, count, ids, data) VALUES (?, ?, ?, ?, ?)",
+                            (book_id, seq, len(chapters), " ".join(chapter[0] for chapter in chapters),
+                             compress(json.dumps(chapters, ensure_ascii=False))))
+            self.db.execute("UPDATE books SET last_cid=?, "
+                            "chapters=(SELECT SUM(count) FROM segments WHERE book_id=?) WHERE id=?",
+                            (chapters[-1][0], book_id, book_id))
+            self.db.commit()
+
+    def version(self, book_id: str):
+        """返回书的版本：最后章节ID，补全过章节时加上补全次数，书不存在或没有章节时返回 None"""
+        with self.lock:
+            row = self.db.execute("SELECT last_cid, revision FROM books WHERE id=?", (book_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return f"{row[0]}.{row[1]}" if row[1] else row[0]
+
+    def add_missing(self, book_id: str, chapter_id: str):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO missing (book_id, chapter_id) VALUES (?, ?)", (book_id, chapter_id))
+            self.db.commit()
+
+    def remove_missing(self, book_id: str, chapter_ids: list):
+        with self.lock:
+            self.db.executemany("DELETE FROM missing WHERE book_id=? AND chapter_id=?",
+                                [(book_id, chapter_id) for chapter_id in chapter_ids])
+            self.db.commit()
+
+    def missing(self, book_id: str) -> list:
+        with self.lock:
+            rows = self.db.execute("SELECT chapter_id FROM missing WHERE book_id=?", (book_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def missing_books(self, limit: int) -> list:
+        """返回有待补全章节的书"""
+        with self.lock:
+            rows = self.db.execute("SELECT DISTINCT book_id FROM missing LIMIT ?", (limit,)).fetchall()
+        return [row[0] for row in rows]
+
+    def replace_chapter(self, book_id: str, chapter_id: str, chapter_title: str, chapter_text: str) -> bool:
+        """替换已保存的章节内容并移出待补全列表，章节不在存储中时返回 False"""
+        with self.lock:
+            # 章节ID以空格分隔保存，先按 ids 找到所在的段，只解压这一段
+            rows = self.db.execute("SELECT seq, data FROM segments WHERE book_id=? AND ' ' || ids || ' ' LIKE ?",
+                                   (book_id, f"% {chapter_id} %")).fetchall()
+            for seq, data in rows:
+                chapters = json.loads(decompress(data))
+                for chapter in chapters:
+                    if chapter[0] == chapter_id:
+                        chapter[1], chapter[2] = chapter_title, chapter_text
+                        break
+                else:
+                    continue
+                self.db.execute("UPDATE segments SET data=? WHERE book_id=? AND seq=?",
+                                (compress(json.dumps(chapters, ensure_ascii=False)), book_id, seq))
+                self.db.execute("DELETE FROM missing WHERE book_id=? AND chapter_id=?", (book_id, chapter_id))
+                self.db.execute("UPDATE books SET revision=revision+1 WHERE id=?", (book_id,))
+                self.db.commit()
+                return True
+        return False
+
+    def chapter_ids(self, book_id: str) -> list:
+        with self.lock:
+            rows = self.db.execute("SELECT ids FROM segments WHERE book_id=? ORDER BY seq", (book_id,)).fetchall()
+        return " ".join(row[0] for row in rows).split()
+
+    def iter_chapters(self, book_id: str):
+        """按顺序逐段解压，依次返回 (章节ID, 标题, 内容)"""
+        seq = -1
+        while True:
+            with self.lock:
+                row = self.db.execute("SELECT seq, data FROM segments WHERE book_id=? AND seq>? ORDER BY seq LIMIT 1",
+                                      (book_id, seq)).fetchone()
+            if row is None:
+                return
+            seq = row[0]
+            yield from json.loads(decompress(row[1]))
+
+
+def compress(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8"), 9)
+
+
+def decompress(data: bytes) -> str:
+    return zlib.decompress(data).decode("utf-8")
+
+
+# 导出文件缓存，包括 txt 文件和超过上传限制时打包的 zip 文件
+# 文件名包含版本（最后章节ID和补全次数）和编码，同一版本重复请求时直接使用，按最近使用时间清理
+class ExportCache:
+    def __init__(self, store: BookStore, export_dir: str, max_size: int):
+        self.store = store
+        self.export_dir = export_dir
+        self.max_size = max_size
+        os.makedirs(export_dir, exist_ok=True)
+
+    def export(self, book_id: str, encoding: str):
+        """返回指定编码的 txt 文件路径，已导出过当前版本时直接使用，书不在存储中时返回 None"""
+        book = self.store.book(book_id)
+        if book is None or book[1] == 0:
+            return None
+        file_path = os.path.join(self.export_dir, f"{book_id}-{self.store.version(book_id)}-{encoding}.txt")
+        if os.path.exists(file_path):
+            os.utime(file_path)
+            return file_path
+        # 逐段解压并编码写入，内存中只保留一段章节；先写临时文件，避免其他线程读到不完整的文件
+        tmp_path = f"{file_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with metrics.EXPORT_SECONDS.time(), open(tmp_path, "wb") as f:
+            f.write(self.store.header(book_id).encode(encoding, errors='ignore'))
+            for _, chapter_title, chapter_text in self.store.iter_chapters(book_id):
+                f.write(f"\n\n\n{chapter_title}\n{chapter_text}".encode(encoding, errors='ignore'))
+        os.replace(tmp_path, file_path)
+        logger.debug(f"ID: {book_id} 已导出 {encoding} 编码的文件")
+        self.remove_stale(book_id, encoding, self.store.version(book_id))
+        self.evict()
+        return file_path
+
+    def remove_stale(self, book_id: str, encoding: str, version: str):
+        """同一本书同一编码只保留最新版本的文件"""
+        prefix = f"{book_id}-"
+        for filename in os.listdir(self.export_dir):
+            if not filename.startswith(prefix) or filename.endswith(".tmp"):
+                continue
+            # 版本中不含 -，编码中可能含有 -
+            file_version, _, rest = filename[len(prefix):].partition("-")
+            if file_version != version and rest.startswith(f"{encoding}."):
+                os.remove(os.path.join(self.export_dir, filename))
+
+    def package(self, book_id: str, encoding: str, filename: str, limit: int):
+        """
+        返回发送给用户的文件路径列表，书不在存储中时返回 None
+        txt 文件不超过 limit 时直接发送；否则压缩为 zip，仍然超过时按章节分卷，每卷一个 zip
+        filename 为压缩包内的文件名
+        """
+        txt_path = self.export(book_id, encoding)
+        if txt_path is None or os.path.getsize(txt_path) <= limit:
+            return None if txt_path is None else [txt_path]
+        base = txt_path[:-len(".txt")]
+        cached = self.cached_volumes(base)
+        # 上传限制调小后，按原来的限制打包的文件不能再用
+        if cached and all(os.path.getsize(path) <= limit for path in cached):
+            for path in cached:
+                os.utime(path)
+            return cached
+        for path in cached:
+            os.remove(path)
+        with metrics.PACKAGE_SECONDS.time():
+            # 先整体压缩，大部分书压缩后即可在限制以内
+            tmp_path = f"{base}.{os.getpid()}-{threading.get_ident()}.tmp"
+            self.write_zip(tmp_path, [(filename, txt_path)])
+            if os.path.getsize(tmp_path) <= limit:
+                os.replace(tmp_path, f"{base}.zip")
+                logger.info(f"ID: {book_id} 文件超过上传限制，已压缩为 zip")
+                self.evict()
+                return [f"{base}.zip"]
+            # 按整体的压缩率估算每卷的原始大小，分卷后仍有超过限制的卷时缩小再试
+            ratio = os.path.getsize(tmp_path) / os.path.getsize(txt_path)
+            os.remove(tmp_path)
+            volume_size = limit * 0.9 / ratio
+            for attempt in range(5):
+                tmp_paths = self.write_volumes(book_id, encoding, filename, volume_size)
+                if all(os.path.getsize(path) <= limit for path in tmp_paths):
+                    break
+                if attempt == 4:
+                    # 单个章节压缩后仍超过限制，无法再分
+                    logger.warning(f"ID: {book_id} 分卷后仍有超过上传限制的卷")
+                    break
+                for path in tmp_paths:
+                    os.remove(path)
+                volume_size *= 0.8
+            # 从最后一卷开始改名，第一卷存在时其余各卷都已存在
+            paths = [f"{base}.part{i + 1}.zip" for i in range(len(tmp_paths))]
+            for tmp_path, path in reversed(list(zip(tmp_paths, paths))):
+                os.replace(tmp_path, path)
+        logger.info(f"ID: {book_id} 文件超过上传限制，已按章节分为{len(paths)}卷")
+        self.evict()
+        return paths
+
+    def package_legacy(self, book_id: str, txt_path: str, source_encoding: str, encoding: str, filename: str,
+                       limit: int) -> list:
+        """
+        旧版本保存的 txt 文件不在存储中，按需转换编码，超过 limit 时整体压缩为 zip
+        没有章节信息无法分卷，压缩后仍超过限制时返回空列表
+        """
+        if encoding != source_encoding:
+            txt_path = self.transcode(book_id, txt_path, source_encoding, encoding)
+        if os.path.getsize(txt_path) <= limit:
+            return [txt_path]
+        base = os.path.join(self.export_dir, f"{book_id}-legacy-{encoding}")
+        # 原文件更新过或上传限制调小后，之前压缩的文件不能再用
+        if os.path.exists(f"{base}.zip") and os.path.getsize(f"{base}.zip") <= limit and \
+                os.path.getmtime(f"{base}.zip") >= os.path.getmtime(txt_path):
+            os.utime(f"{base}.zip")
+            return [f"{base}.zip"]
+        with metrics.PACKAGE_SECONDS.time():
+            tmp_path = f"{base}.{os.getpid()}-{threading.get_ident()}.tmp"
+            self.write_zip(tmp_path, [(filename, txt_path)])
+            if os.path.getsize(tmp_path) > limit:
+                os.remove(tmp_path)
+                logger.warning(f"ID: {book_id} 旧版本文件压缩后仍超过上传限制")
+                return []
+            os.replace(tmp_path, f"{base}.zip")
+        logger.info(f"ID: {book_id} 旧版本文件超过上传限制，已压缩为 zip")
+        self.evict()
+        return [f"{base}.zip"]
+
+    def transcode(self, book_id: str, txt_path: str, source_encoding: str, encoding: str) -> str:
+        """把旧版本的 txt 文件转换为指定编码，原文件没有更新时直接使用上次转换的结果"""
+        file_path = os.path.join(self.export_dir, f"{book_id}-legacy-{encoding}.txt")
+        if os.path.exists(file_path) and os.path.getmtime(file_path) >= os.path.getmtime(txt_path):
+            os.utime(file_path)
+            return file_path
+        tmp_path = f"{file_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with metrics.EXPORT_SECONDS.time(), \
+                open(txt_path, "r", encoding=source_encoding, errors="ignore", newline="") as src, \
+                open(tmp_path, "w", encoding=encoding, errors="ignore", newline="") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, file_path)
+        logger.debug(f"ID: {book_id} 已将旧版本文件转换为 {encoding} 编码")
+        self.evict()
+        return file_path
+
+    @staticmethod
+    def cached_volumes(base: str) -> list:
+        """返回已打包的文件，没有时返回空列表"""
+        if os.path.exists(f"{base}.zip"):
+            return [f"{base}.zip"]
+        paths = []
+        while os.path.exists(f"{base}.part{len(paths) + 1}.zip"):
+            paths.append(f"{base}.part{len(paths) + 1}.zip")
+        return paths
+
+    @staticmethod
+    def write_zip(zip_path: str, entries: list):
+        """把 [(压缩包内文件名, 文件路径)] 逐块压缩写入 zip_path"""
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+            for name, path in entries:
+                with open(path, "rb") as src, archive.open(name, "w", force_zip64=True) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def write_volumes(self, book_id: str, encoding: str, filename: str, volume_size: float) -> list:
+        """按章节分卷，每卷原始大小不超过 volume_size（单个章节超过时单独成卷），返回各卷的临时文件路径"""
+        stem, ext = os.path.splitext(filename)
+        prefix = os.path.join(self.export_dir, f"{book_id}-{os.getpid()}-{threading.get_ident()}")
+        paths = []
+        archive = dst = None
+        size = 0
+
+        def close():
+            if archive is not None:
+                dst.close()
+                archive.close()
+
+        def open_volume():
+            nonlocal archive, dst, size
+            close()
+            paths.append(f"{prefix}.part{len(paths) + 1}.tmp")
+            archive = zipfile.ZipFile(paths[-1], "w", zipfile.ZIP_DEFLATED, compresslevel=6)
+            dst = archive.open(f"{stem}_{len(paths)}{ext}", "w", force_zip64=True)
+            size = 0
+
+        try:
+            open_volume()
+            data = self.store.header(book_id).encode(encoding, errors='ignore')
+            dst.write(data)
+            size += len(data)
+            for _, chapter_title, chapter_text in self.store.iter_chapters(book_id):
+                data = f"\n\n\n{chapter_title}\n{chapter_text}".encode(encoding, errors='ignore')
+                if size > 0 and size + len(data) > volume_size:
+                    open_volume()
+                dst.write(data)
+                size += len(data)
+        finally:
+            close()
+        return paths
+
+    def evict(self):
+        """导出文件总大小超过限制时，按最近使用时间删除旧文件，直到降到限制的90%以下"""
+        files = []
+        for filename in os.listdir(self.export_dir):
+            if filename.endswith((".txt", ".zip")):
+                stat = os.stat(os.path.join(self.export_dir, filename))
+                files.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(file[1] for file in files)
+        if total <= self.max_size:
+            return
+        target = self.max_size * 0.9
+        removed = 0
+        for _, size, filename in sorted(files):
+            if total <= target:
+                break
+            os.remove(os.path.join(self.export_dir, filename))
+            total -= size
+            removed += 1
+        logger.info(f"导出文件缓存超过大小限制，已清理{removed}个文件")
+
+
+# 每个进程共用一个存储实例，进程池 fork 出的子进程不能沿用父进程的数据库连接
+_store = None
+_export_cache = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def get_book_store(config: dict) -> BookStore:
+    global _store, _export_cache, _store_pid
+    with _store_lock:
+        if _store is None or _store_pid != os.getpid():
+            options = config.get("storage", {})
+            _store = BookStore(os.path.join(config["save_dir"], "books.db"))
+            _export_cache = ExportCache(_store, os.path.join(config.get("cache", {}).get("dir", "cache"), "exports"),
+                                        p.parse_size(options.get("export_cache_size", "1 GB")))
+            _store_pid = os.getpid()
+        return _store
+
+
+def package_book(config: dict, book_id: str, encoding: str, filename: str):
+    """
+    准备发送给用户的文件，超过上传限制时压缩或分卷，返回文件路径列表，书不在存储中时返回 None
+    filename 为发送给用户的文件名
+    """
+    get_book_store(config)
+    limit = p.parse_size(config.get("storage", {}).get("upload_limit", "50 MB"))
+    return _export_cache.package(book_id, encoding, filename, limit)
+
+
+def package_legacy_book(config: dict, book_id: str, txt_path: str, encoding: str, filename: str) -> list:
+    """
+    准备旧版本保存的 txt 文件，返回文件路径列表，压缩后仍超过上传限制时返回空列表
+    旧版本按默认编码保存，请求其他编码时先转换
+    """
+    get_book_store(config)
+    limit = p.parse_size(config.get("storage", {}).get("upload_limit", "50 MB"))
+    return _export_cache.package_legacy(book_id, txt_path, config["encoding"], encoding, filename, limit)
+
+
+def book_version(config: dict, book_id: str):
+    """返回书在存储中的版本，用于区分已上传的文件，书不在存储中时返回 None"""
+    return get_book_store(config).version(book_id)
+
+
+def get_visible_name(config: dict, title: str, book_id: str, encoding: str) -> str:
+    """发送给用户的文件名，非默认编码时在扩展名前加上编码"""
+    filename = config["filename_format"].format(title=title, book_id=book_id)
+    if encoding != config["encoding"]:
+        name, ext = os.path.splitext(filename)
+        filename = f"{name}_{encoding}{ext}"
+    return filename
@@ -0,0 +1,89 @@
+
+# 导入必要的模块
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# noinspection PyPackageRequirements
+import telebot
+from loguru import logger
+
+
+# Webhook 模式：Telegram 把更新推送到本地的 HTTP 服务，收到后立即返回，交给固定数量的线程处理
+# 等待处理的更新超过上限时返回 503，由 Telegram 稍后重新推送，避免高峰时无限堆积
+class WebhookServer:
+    def __init__(self, bot: telebot.TeleBot, options: dict, handler_threads: int):
+        self.bot = bot
+        self.url = options["url"].rstrip("/")
+        self.path = options.get("path", "/webhook")
+        self.listen = options.get("listen", "0.0.0.0")
+        self.port = options.get("port", 8443)
+        self.secret_token = options.get("secret_token") or None
+        self.max_connections = options.get("max_connections", 40)
+        self.executor = ThreadPoolExecutor(max_workers=handler_threads, thread_name_prefix="handler")
+        # 正在处理和等待处理的更新数
+        self.slots = threading.BoundedSemaphore(handler_threads + options.get("max_pending", 100))
+        self.server = None
+
+    def submit(self, body: bytes) -> bool:
+        """把更新交给处理线程，已达到上限时返回 False"""
+        update = telebot.types.Update.de_json(json.loads(body.decode("utf-8")))
+        if not self.slots.acquire(blocking=False):
+            return False
+        future = self.executor.submit(self.process, update)
+        future.add_done_callback(lambda _: self.slots.release())
+        return True
+
+    def process(self, update):
+        # noinspection PyBroadException
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as e:
+            logger.exception(f"处理更新 {update.update_id} 失败: {e}")
+
+    def make_handler(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.split("?")[0] != webhook.path:
+                    self.send_error(404)
+                    return
+                if webhook.secret_token is not None and \
+                        self.headers.get("X-Telegram-Bot-Api-Secret-Token") != webhook.secret_token:
+                    self.send_error(403)
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                # noinspection PyBroadException
+                try:
+                    accepted = webhook.submit(body)
+                except Exception as e:
+                    # 无法解析的更新直接丢弃，返回 200 避免 Telegram 反复推送
+                    logger.warning(f"无法解析的更新: {e}")
+                    accepted = True
+                if not accepted:
+                    logger.warning("等待处理的更新过多，暂时拒绝")
+                    self.send_error(503)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def serve_forever(self):
+        self.server = ThreadingHTTPServer((self.listen, self.port), self.make_handler())
+        self.server.daemon_threads = True
+        self.bot.remove_webhook()
+        self.bot.set_webhook(url=self.url + self.path, secret_token=self.secret_token,
+                             max_connections=self.max_connections)
+        logger.info(f"Webhook 服务已启动: {self.listen}:{self.server.server_port}{self.path}，"
+                    f"Telegram 推送地址: {self.url}{self.path}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,44 @@
+
+# 下载进程的入口，只导入下载需要的模块，不导入机器人和数据库
+# 进程池创建的进程从这里开始，启动时不需要加载配置文件、连接数据库或创建机器人实例
+import os
+
+from loguru import logger
+
+import metrics
+import public as p
+from fanqie_api import download, update
+from fetcher import set_pacer_state
+
+# 工作进程内常驻的配置，由进程池初始化函数设置
+_config = None
+
+
+def init_worker(config: dict, pacer_state=None, main_logger=None):
+    """进程池初始化函数，pacer_state 为所有进程共用的限速器状态，main_logger 为主进程的日志对象"""
+    global _config
+    _config = config
+    if main_logger is not None:
+        # forkserver 启动的进程不会继承主进程的日志设置，本进程的日志交给主进程的日志对象写入日志队列
+        logger.remove()
+        logger.add(lambda message: forward_log(main_logger, message.record), format="{message}", catch=False)
+    p.configure_http(config.get("http", {}))
+    if pacer_state is not None:
+        set_pacer_state(pacer_state)
+    # 清除从主进程继承的指标数据，之后只统计本进程的数据
+    metrics.REGISTRY.collect()
+    logger.debug(f"工作进程 {os.getpid()} 初始化完成")
+
+
+def forward_log(main_logger, record: dict):
+    """按原有的时间、位置和异常信息重新记录一条日志"""
+    main_logger.patch(lambda r: r.update(record)).log(record["level"].name, record["message"])
+
+
+def run_job(job: dict) -> tuple:
+    """执行主进程发来的任务描述，返回任务结果和本次任务记录的指标数据，由主进程发送给用户"""
+    if job["mode"] == "update":
+        result = update(job["url"], job["start_id"], _config)
+    else:
+        result = download(job["url"], _config)
+    return result, metrics.REGISTRY.collect()
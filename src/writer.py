@@ -0,0 +1,102 @@
+
+# 导入必要的模块
+import metrics
+from loguru import logger
+from storage import BookStore
+
+
+# 获取失败的章节的占位内容
+MISSING_TEXT = "（本章暂时获取失败，将在之后的更新中补全）"
+
+
+# 按章节写入小说存储，章节先在内存中凑满一段，再压缩保存为一段
+# 已保存的段即为检查点，任务中断后从最后保存的章节继续，未保存的章节重新获取（通常可从章节缓存中取得）
+class BookWriter:
+    def __init__(self, store: BookStore, book_id: str, segment_chapters: int = 20):
+        self.store = store
+        self.book_id = book_id
+        self.segment_chapters = max(segment_chapters, 1)
+        self.seq = 0
+        self.pending = []
+        self.dirty = False
+        self.last_cid = None
+
+    def open(self, append: bool = False):
+        """
+        准备写入，返回上次中断时最后保存的章节ID，没有未完成的写入时返回 None
+        append 为 True 时在已保存的章节之后继续写入，否则清空已有的章节重新写入
+        """
+        book = self.store.book(self.book_id)
+        if book is None or not (book[2] or append):
+            self.store.reset(self.book_id)
+            self.seq, self.pending, self.last_cid = 0, [], None
+            return None
+        self.last_cid = book[0]
+        # 最后一段未满时读回内存，继续写入的章节与其合并为一段
+        last = self.store.last_segment(self.book_id)
+        if last is None:
+            self.seq, self.pending = 0, []
+        elif len(last[1]) < self.segment_chapters:
+            self.seq, self.pending = last
+        else:
+            self.seq, self.pending = last[0] + 1, []
+        resume_cid = self.last_cid if book[2] else None
+        self.store.set_writing(self.book_id, True)
+        return resume_cid
+
+    def chapter_ids(self) -> list:
+        """返回已保存的章节ID"""
+        return self.store.chapter_ids(self.book_id)
+
+    def write(self, content: str):
+        """写入章节以外的内容（小说信息）"""
+        self.store.put_header(self.book_id, content)
+
+    def write_chapter(self, chapter_title: str, chapter_text: str, chapter_id: str):
+        self.pending.append([chapter_id, chapter_title, chapter_text])
+        metrics.CHAPTERS_WRITTEN.inc()
+        self.dirty = True
+        self.last_cid = chapter_id
+        if len(self.pending) >= self.segment_chapters:
+            self.flush()
+            self.seq += 1
+            self.pending = []
+
+    def write_missing(self, chapter_title: str, chapter_id: str):
+        """章节获取失败时写入占位内容，保持章节顺序，记录下来之后重新获取"""
+        self.store.add_missing(self.book_id, chapter_id)
+        metrics.CHAPTERS_MISSING.inc()
+        self.write_chapter(chapter_title, MISSING_TEXT, chapter_id)
+
+    def missing(self) -> list:
+        """返回待补全的章节ID"""
+        return self.store.missing(self.book_id)
+
+    def drop_missing(self, chapter_ids: list):
+        """不再补全的章节（已不在目录中）"""
+        self.store.remove_missing(self.book_id, chapter_ids)
+
+    def replace_chapter(self, chapter_title: str, chapter_text: str, chapter_id: str):
+        """用重新获取的内容替换占位章节"""
+        self.flush()
+        if not self.store.replace_chapter(self.book_id, chapter_id, chapter_title, chapter_text):
+            logger.warning(f"ID: {self.book_id} 章节ID: {chapter_id} 不在存储中，无法补全")
+            self.drop_missing([chapter_id])
+            return
+        # 未写满的最后一段同时保留在内存中，一并替换，避免之后写入时覆盖
+        for chapter in self.pending:
+            if chapter[0] == chapter_id:
+                chapter[1], chapter[2] = chapter_title, chapter_text
+        metrics.CHAPTERS_RECOVERED.inc()
+
+    def flush(self):
+        if self.dirty and self.pending:
+            with metrics.STORE_SECONDS.time():
+                self.store.put_segment(self.book_id, self.seq, self.pending)
+        self.dirty = False
+
+    def close(self, done: bool = True):
+        """保存剩余的章节，done 为 True 表示任务已完成"""
+        self.flush()
+        if done:
+            self.store.set_writing(self.book_id, False)